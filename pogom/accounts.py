@@ -0,0 +1,308 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import logging
+import time
+
+from heapq import heappop, heappush
+from itertools import count
+from threading import Condition, Thread
+
+from pgoapi import PGoApi
+from pgoapi.exceptions import AuthException
+from queue import Empty
+
+from .fakePogoApi import FakePogoApi
+
+log = logging.getLogger(__name__)
+
+
+def new_api(args, proxy_url, encryption_lib_path):
+    # Create the API instance an account searches with
+    if args.mock != '':
+        api = FakePogoApi(args.mock)
+    else:
+        api = PGoApi()
+
+    if proxy_url:
+        log.debug("Using proxy %s", proxy_url)
+        api.set_proxy({'http': proxy_url, 'https': proxy_url})
+
+    api.activate_signature(encryption_lib_path)
+    return api
+
+
+def ticket_expire(api):
+    # When the api's login runs out (in seconds), 0 if it isn't logged in
+    if api._auth_provider and api._auth_provider._ticket_expire:
+        return api._auth_provider._ticket_expire / 1000.0
+    return 0
+
+
+class LoginManager(object):
+    '''
+    Logs accounts in ahead of time on a small pool of threads, so workers
+    don't stall on a login in the middle of their loop.
+
+    Accounts the workers are searching with get a fresh login shortly
+    before their ticket runs out, on an api instance of their own; the
+    worker swaps it in with take() before its next scan. Spare accounts
+    are logged in once, shortly before they're needed (e.g. before they're
+    done resting), so whoever takes one can start scanning right away; a
+    spare nobody takes isn't logged in again. Spares log in through a proxy
+    picked from the proxy pool at the time; the session that takes one
+    stays on that proxy.
+    '''
+
+    # Log in again when a ticket has less than this many seconds left, and
+    # log spares in this long before they're needed
+    MARGIN = 300
+
+    def __init__(self, args, encryption_lib_path, threads, proxy_pool=None):
+        self.args = args
+        self.encryption_lib_path = encryption_lib_path
+        self.threads = threads
+        self.proxy_pool = proxy_pool
+        # username: (account, proxy url, sequence number of its next login)
+        # of the accounts kept logged in
+        self.accounts = {}
+        # username: (logged in api nobody has taken yet, proxy url it used)
+        self.ready = {}
+        # Usernames of the tracked accounts that are spares, logged in only once
+        self.spares = set()
+        # Heap of (login time, sequence number, username)
+        self.due = []
+        self.sequence = count()
+        self.changed = Condition()
+
+    def start(self):
+        for i in range(self.threads):
+            t = Thread(target=self.run, name='login-manager-{}'.format(i))
+            t.daemon = True
+            t.start()
+
+    def prepare(self, account, proxy_url=None, when=None):
+        # Log a spare account in ahead of time, for whoever takes it at when
+        # (default now)
+        with self.changed:
+            self.spares.add(account['username'])
+            self._schedule(account, proxy_url, (when or time.time()) - self.MARGIN)
+
+    def keep_fresh(self, account, api, proxy_url):
+        # Log an account that's in use in again before api's ticket runs out
+        with self.changed:
+            tracked = self.accounts.get(account['username'])
+            if tracked and tracked[1] == proxy_url and account['username'] not in self.spares:
+                return
+            self.spares.discard(account['username'])
+            self._schedule(account, proxy_url, ticket_expire(api) - self.MARGIN)
+
+    def take(self, account):
+        # A freshly logged in api for the account and the proxy it logged in
+        # through, if there is one; (None, None) otherwise
+        with self.changed:
+            api, proxy_url = self.ready.pop(account['username'], (None, None))
+        if api and ticket_expire(api) - time.time() > 60:
+            return api, proxy_url
+        return None, None
+
+    def forget(self, account):
+        # Stop looking after an account, e.g. when it's rotated out to rest
+        with self.changed:
+            self.accounts.pop(account['username'], None)
+            self.ready.pop(account['username'], None)
+            self.spares.discard(account['username'])
+
+    def _schedule(self, account, proxy_url, when):
+        # Replaces whatever login was scheduled for the account before
+        sequence = next(self.sequence)
+        self.accounts[account['username']] = (account, proxy_url, sequence)
+        heappush(self.due, (when, sequence, account['username']))
+        self.changed.notify()
+
+    def run(self):
+        while True:
+            with self.changed:
+                while True:
+                    wait = None
+                    if self.due:
+                        wait = self.due[0][0] - time.time()
+                        if wait <= 0:
+                            break
+                    self.changed.wait(wait)
+                when, sequence, username = heappop(self.due)
+                # Forgotten or rescheduled meanwhile
+                if self.accounts.get(username, (None, None, None))[2] != sequence:
+                    continue
+                account, proxy_url, sequence = self.accounts[username]
+
+            # Spares go through whichever proxy is doing best right now
+            login_proxy = proxy_url or None
+            if not login_proxy and self.proxy_pool:
+                login_proxy = self.proxy_pool.choose()
+            api = self.login(account, login_proxy)
+
+            with self.changed:
+                if self.accounts.get(username, (None, None, None))[2] != sequence:
+                    continue
+                if api:
+                    self.ready[username] = (api, login_proxy)
+                    if username in self.spares:
+                        # Kept fresh again only once a worker searches with it
+                        self.spares.discard(username)
+                        del self.accounts[username]
+                    else:
+                        self._schedule(account, proxy_url, ticket_expire(api) - self.MARGIN)
+                else:
+                    # Try again in a bit; the worker can still log in itself meanwhile
+                    self._schedule(account, proxy_url, time.time() + self.MARGIN / 5)
+
+    def login(self, account, proxy_url):
+        # Never from our own address when there are proxies to use
+        if self.args.proxy and not proxy_url:
+            return None
+
+        api = new_api(self.args, proxy_url, self.encryption_lib_path)
+        for i in range(self.args.login_retries):
+            try:
+                if proxy_url:
+                    api.set_authentication(provider=account['auth_service'], username=account['username'], password=account['password'], proxy_config={'http': proxy_url, 'https': proxy_url})
+                else:
+                    api.set_authentication(provider=account['auth_service'], username=account['username'], password=account['password'])
+                log.debug('Logged in account %s ahead of time', account['username'])
+                return api
+            except AuthException:
+                log.warning('Failed to log in account %s ahead of time, trying again in %g seconds', account['username'], self.args.login_delay)
+                time.sleep(self.args.login_delay)
+            except Exception as e:
+                log.warning('Exception while logging in account %s ahead of time: %s', account['username'], e)
+                break
+        return None
+
+
+class AccountPool(object):
+    '''
+    The accounts workers search with. Accounts that are ready wait in a heap
+    ordered by their health, so get() hands out the healthiest one; accounts
+    resting (after too many failures, an exception or a rotation) wait in a
+    heap ordered by when they're done, and go back to work the moment they
+    are, waking up a worker waiting for one.
+
+    An account's health is a moving average of how many of its scans fail
+    and how many come back empty, less a penalty for every time it looked
+    banned. The penalty halves every BAN_HALF_LIFE seconds, so a captcha
+    or a blip doesn't mark an account for good.
+    '''
+
+    # Weight of the latest scan in the moving averages
+    ALPHA = 0.1
+    # Seconds for the penalty of looking banned to wear off by half
+    BAN_HALF_LIFE = 3600
+
+    def __init__(self, rest_interval, login_manager=None):
+        self.rest_interval = rest_interval
+        self.login_manager = login_manager
+        # username: {'fail': rate, 'empty': rate, 'bans': count, 'banned_at': time of the last}
+        self.health = {}
+        # Heap of (-health, sequence number, account)
+        self.ready = []
+        # Heap of (ready time, sequence number, account, reason)
+        self.resting = []
+        self.sequence = count()
+        self.changed = Condition()
+
+    def put(self, account):
+        # An account ready to search with
+        with self.changed:
+            self._ready(account)
+            self.changed.notify()
+
+    def rest(self, account, reason, since=None):
+        # Take an account off duty for the rest interval, counting from since
+        until = (since or time.time()) + self.rest_interval
+        with self.changed:
+            heappush(self.resting, (until, next(self.sequence), account, reason))
+            # Whoever is waiting may need to wake up sooner now
+            self.changed.notify()
+        log.info('Account %s resting until %s due to %s', account['username'], time.strftime('%H:%M:%S', time.localtime(until)), reason)
+
+        if self.login_manager:
+            self.login_manager.prepare(account, when=until)
+
+    def get(self, block=True, timeout=None):
+        # The healthiest account that's ready, waiting for one if need be
+        deadline = None if timeout is None else time.time() + timeout
+        with self.changed:
+            while True:
+                self._wake(time.time())
+                if self.ready:
+                    return heappop(self.ready)[2]
+                if not block:
+                    raise Empty
+
+                wait = None
+                if self.resting:
+                    wait = self.resting[0][0] - time.time()
+                if deadline is not None:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise Empty
+                    wait = remaining if wait is None else min(wait, remaining)
+                self.changed.wait(wait)
+
+    def record(self, account, result):
+        # How a scan went: 'success', 'empty', 'fail' or 'banned'
+        with self.changed:
+            health = self._health(account['username'])
+            health['fail'] += self.ALPHA * ((result in ('fail', 'banned')) - health['fail'])
+            health['empty'] += self.ALPHA * ((result == 'empty') - health['empty'])
+            if result == 'banned':
+                health['bans'] = self._bans(health) + 1
+                health['banned_at'] = time.time()
+
+    def score(self, username):
+        with self.changed:
+            return self._score(username)
+
+    def holds(self):
+        # The accounts resting, soonest done first
+        with self.changed:
+            self._wake(time.time())
+            return [{'account': account, 'last_fail_time': until - self.rest_interval, 'reason': reason}
+                    for until, sequence, account, reason in sorted(self.resting)]
+
+    def qsize(self):
+        # Accounts ready to be handed out
+        with self.changed:
+            self._wake(time.time())
+            return len(self.ready)
+
+    def resting_count(self):
+        with self.changed:
+            self._wake(time.time())
+            return len(self.resting)
+
+    def _wake(self, now):
+        while self.resting and self.resting[0][0] <= now:
+            account = heappop(self.resting)[2]
+            log.info('Account %s returning to active duty.', account['username'])
+            self._ready(account)
+
+    def _ready(self, account):
+        # Equally healthy accounts are handed out in the order they came in
+        heappush(self.ready, (-self._score(account['username']), next(self.sequence), account))
+
+    def _health(self, username):
+        if username not in self.health:
+            self.health[username] = {'fail': 0.0, 'empty': 0.0, 'bans': 0.0, 'banned_at': 0}
+        return self.health[username]
+
+    def _bans(self, health):
+        # The bans, worn off by the time since the last one
+        if not health['bans']:
+            return 0.0
+        return health['bans'] * 0.5 ** ((time.time() - health['banned_at']) / self.BAN_HALF_LIFE)
+
+    def _score(self, username):
+        health = self._health(username)
+        return 1.0 - health['fail'] - health['empty'] / 2 - self._bans(health) / 4
@@ -8,6 +8,7 @@ from flask import Flask, abort, jsonify, render_template, request
 from flask.json import JSONEncoder
 from flask_compress import Compress
 from datetime import datetime
+from base64 import b64encode
 from s2sphere import LatLng
 from pogom.utils import get_args
 from datetime import timedelta
@@ -35,6 +36,8 @@ class Pogom(Flask):
         self.route("/stats", methods=['GET'])(self.get_stats)
         self.route("/status", methods=['GET'])(self.get_status)
         self.route("/status", methods=['POST'])(self.post_status)
+        self.route("/work/lease", methods=['POST'])(self.post_work_lease)
+        self.route("/work/ack", methods=['POST'])(self.post_work_ack)
 
     def set_search_control(self, control):
         self.search_control = control
@@ -45,6 +48,9 @@ class Pogom(Flask):
     def set_current_location(self, location):
         self.current_location = location
 
+    def set_work_leases(self, leases):
+        self.work_leases = leases
+
     def get_search_control(self):
         return jsonify({'status': not self.search_control.is_set()})
 
@@ -128,6 +134,9 @@ class Pogom(Flask):
                 d['main_workers'] = MainWorker.get_all()
                 d['workers'] = WorkerStatus.get_all()
 
+        if get_args().compact_ids:
+            export_compact_ids(d)
+
         return jsonify(d)
 
     def loc(self):
@@ -264,6 +273,47 @@ class Pogom(Flask):
             d['login'] = 'failed'
         return jsonify(d)
 
+    def check_work_request(self):
+        args = get_args()
+        if self.work_leases is None:
+            abort(404)
+        if not args.coordinator_key or request.form.get('key') != args.coordinator_key:
+            abort(403)
+
+    def post_work_lease(self):
+        self.check_work_request()
+
+        position = None
+        lat = request.form.get('lat', type=float)
+        lng = request.form.get('lng', type=float)
+        if lat is not None and lng is not None:
+            position = (lat, lng, 0)
+
+        node = request.form.get('node', request.remote_addr)
+        lease, item = self.work_leases.lease(node, position, request.form.get('last_scan', 0, type=float))
+        if lease is None:
+            # item is how long to wait for the next one instead
+            return jsonify({'lease': None, 'retry': item})
+        return jsonify({'lease': lease, 'item': item})
+
+    def post_work_ack(self):
+        self.check_work_request()
+        return jsonify({'acked': self.work_leases.ack(request.form.get('lease', ''))})
+
+
+def export_compact_ids(d):
+    # With --compact-ids, ids come out of the database as integers. Hand the
+    # front-end strings instead, with encounter ids in the same base64 format
+    # it gets without compact ids.
+    for p in d.get('pokemons', []) + d.get('appearances', []):
+        p['encounter_id'] = b64encode(str(p['encounter_id']))
+    for p in d.get('pokestops', []):
+        p['pokestop_id'] = str(p['pokestop_id'])
+    for g in d.get('gyms', {}).values():
+        g['gym_id'] = str(g['gym_id'])
+        for p in g['pokemon']:
+            p['gym_id'] = str(p['gym_id'])
+
 
 class CustomJSONEncoder(JSONEncoder):
 
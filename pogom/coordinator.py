@@ -0,0 +1,196 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import logging
+import time
+import requests
+
+from threading import Lock
+from uuid import uuid4
+from queue import Empty
+
+log = logging.getLogger(__name__)
+
+
+class WorkLeases(object):
+    '''
+    The coordinator's side of --coordinator: hands items from the search
+    queue out to remote nodes as leases. A node acks a lease once it has
+    scanned the item; leases that aren't acked within the timeout (the node
+    died, or couldn't scan it) go back on the queue for someone else,
+    unless the schedule they came from was thrown away meanwhile.
+    '''
+
+    def __init__(self, timeout):
+        self.timeout = timeout
+        self.queue = None
+        # lease id: (expiry time, node, item)
+        self.leases = {}
+        # Bumped by clear(), to recognise items from a schedule thrown away
+        self.generation = 0
+        self.lock = Lock()
+
+    def attach(self, queue):
+        # The overseer's search queue, once it has one
+        self.queue = queue
+
+    def lease(self, node, position=None, last_scan=0):
+        # (lease id, item), or (None, seconds until it's worth asking again)
+        if self.queue is None:
+            return None, 5
+
+        self.expire()
+        with self.lock:
+            generation = self.generation
+        try:
+            item = self.queue.get(False, position=position, last_scan=last_scan)
+        except Empty:
+            return None, self.queue.ready_in(position, last_scan)
+
+        lease = uuid4().hex
+        with self.lock:
+            if generation != self.generation:
+                # Taken from the schedule that was just thrown away
+                return None, 1
+            self.leases[lease] = (time.time() + self.timeout, node, item)
+        log.debug('Leased step %d to %s', item[0], node)
+        return lease, item
+
+    def ack(self, lease):
+        # False if the lease already expired (or was dropped with the schedule)
+        with self.lock:
+            if self.leases.pop(lease, None) is None:
+                return False
+        self.queue.task_done()
+        return True
+
+    def expire(self):
+        # Requeued under the lock, so a clear() can't come in between and
+        # leave items of the old schedule in the new one
+        now = time.time()
+        with self.lock:
+            expired = [lease for lease, (expiry, node, item) in self.leases.items() if expiry < now]
+            for expiry, node, item in [self.leases.pop(lease) for lease in expired]:
+                log.info('Lease of step %d by %s expired, queueing it again', item[0], node)
+                self.queue.force_put(item)
+                self.queue.task_done()
+
+    def clear(self):
+        # The schedule is being thrown away; so are the items out on lease.
+        # Call before clearing the queue, so nothing expired ends up back in it.
+        with self.lock:
+            self.leases.clear()
+            self.generation += 1
+
+    def items(self):
+        # Items out on lease, e.g. to scan again after a restart
+        with self.lock:
+            return [item for expiry, node, item in self.leases.values()]
+
+    def size(self):
+        with self.lock:
+            return len(self.leases)
+
+
+class LeasedItem(tuple):
+    '''
+    A search item leased from the coordinator, carrying the id of its lease.
+    Two workers can lease equal items (the same hex step in two loops), so
+    the lease id is what tells them apart when they're acked.
+    '''
+
+    def __new__(cls, item, lease=None):
+        self = tuple.__new__(cls, item)
+        self.lease = lease
+        return self
+
+
+class CoordinatorQueue(object):
+    '''
+    Stands in for the search queue on a node that gets its search items from
+    a coordinator (--coordinator-url). get() leases the next item for this
+    node's position, task_done(item) acks it. Items a worker gives up on are
+    never acked, so the coordinator hands them out again once the lease runs
+    out.
+    '''
+
+    def __init__(self, url, node, key=None):
+        self.url = url.rstrip('/')
+        self.node = node
+        self.key = key
+        # lease id: item
+        self.leases = {}
+        self.lock = Lock()
+        # What the coordinator last said about when to ask again
+        self.retry = None
+
+    def request(self, path, data):
+        if self.key:
+            data['key'] = self.key
+        response = requests.post(self.url + path, data=data, timeout=10)
+        response.raise_for_status()
+        return response.json()
+
+    def get(self, block=True, timeout=None, position=None, last_scan=0):
+        deadline = None if timeout is None else time.time() + timeout
+        data = {'node': self.node, 'last_scan': last_scan}
+        if position:
+            data['lat'], data['lng'] = position[0], position[1]
+
+        while True:
+            try:
+                response = self.request('/work/lease', data)
+                self.retry = response.get('retry')
+            except (requests.exceptions.RequestException, ValueError) as e:
+                log.warning('Unable to lease a search item from %s: %s', self.url, e)
+                response = {}
+                self.retry = 5
+
+            if response.get('lease'):
+                step, location, appears, leaves = response['item']
+                item = LeasedItem((step, tuple(location), appears, leaves), response['lease'])
+                with self.lock:
+                    self.leases[item.lease] = item
+                return item
+
+            if not block:
+                raise Empty
+            wait = 1 if self.retry is None else self.retry
+            if deadline is not None:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise Empty
+                wait = min(wait, remaining)
+            time.sleep(wait)
+
+    def task_done(self, item=None):
+        lease = getattr(item, 'lease', None)
+        with self.lock:
+            if self.leases.pop(lease, None) is None:
+                return
+
+        try:
+            self.request('/work/ack', {'lease': lease})
+        except (requests.exceptions.RequestException, ValueError) as e:
+            log.warning('Unable to ack step %d to %s: %s', item[0], self.url, e)
+
+    def ready_in(self, position=None, last_scan=0):
+        return self.retry
+
+    def peek(self):
+        # The coordinator doesn't say what's next
+        return None
+
+    def items(self):
+        # Nothing is queued here, there's nothing to checkpoint
+        return []
+
+    def qsize(self):
+        # Items leased and not acked yet
+        with self.lock:
+            return len(self.leases)
+
+    def clear(self):
+        # Nothing is queued here; unacked leases just run out at the coordinator
+        with self.lock:
+            self.leases.clear()
@@ -0,0 +1,69 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import logging
+import time
+
+from heapq import heappop, heappush
+from itertools import count
+from threading import Condition, Thread
+
+log = logging.getLogger(__name__)
+
+
+class CoroutineEngine(object):
+    '''
+    Runs generator based coroutines on a small, fixed pool of threads.
+
+    A coroutine yields the number of seconds it wants to sleep and is resumed
+    by whichever engine thread is free once that time has passed, so a
+    sleeping coroutine costs no more than its generator frame. Blocking calls
+    made between two yields (logins, api requests, queue puts) hold on to the
+    thread running them; the size of the pool therefore also bounds how many
+    of those are in flight at once.
+
+    A coroutine is done when it returns. Exceptions escaping one are logged
+    and end that coroutine only.
+    '''
+
+    def __init__(self, threads, name='engine'):
+        self.threads = threads
+        self.name = name
+        # Heap of (wake up time, sequence number, coroutine)
+        self.sleeping = []
+        self.sequence = count()
+        self.wakeup = Condition()
+
+    def spawn(self, coroutine, delay=0):
+        with self.wakeup:
+            heappush(self.sleeping, (time.time() + delay, next(self.sequence), coroutine))
+            self.wakeup.notify()
+
+    def start(self):
+        for i in range(self.threads):
+            t = Thread(target=self.run, name='{}-{}'.format(self.name, i))
+            t.daemon = True
+            t.start()
+
+    def run(self):
+        while True:
+            with self.wakeup:
+                while True:
+                    wait = None
+                    if self.sleeping:
+                        wait = self.sleeping[0][0] - time.time()
+                        if wait <= 0:
+                            break
+                    # Woken early by spawn() when something is due sooner
+                    self.wakeup.wait(wait)
+                coroutine = heappop(self.sleeping)[2]
+
+            try:
+                delay = next(coroutine)
+            except StopIteration:
+                continue
+            except Exception:
+                log.exception('Coroutine %s crashed', getattr(coroutine, '__name__', coroutine))
+                continue
+
+            self.spawn(coroutine, delay or 0)
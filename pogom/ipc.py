@@ -0,0 +1,67 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import logging
+import os
+
+from multiprocessing.managers import BaseManager
+from threading import Thread
+
+log = logging.getLogger(__name__)
+
+# Objects the overseer shares with its scanner processes
+SHARED = ('search_items', 'accounts', 'pause_bit', 'db_updates',
+          'wh_updates', 'status', 'step_yields', 'proxies')
+
+
+class ScannerManager(BaseManager):
+    '''
+    Serves the overseer's queues, accounts and status to the scanner
+    processes. Every method call on one of the proxies a scanner gets from
+    connect() runs on the real object in the overseer process.
+    '''
+    pass
+
+
+def serve(objects):
+    # Share objects (name: object, None for the ones not in use) on a local
+    # socket; returns the address, key and names scanners connect() with
+    names = [name for name, obj in objects.items() if obj is not None]
+    for name in names:
+        ScannerManager.register(name, callable=lambda obj=objects[name]: obj)
+
+    authkey = os.urandom(16)
+    server = ScannerManager(('127.0.0.1', 0), authkey).get_server()
+    t = Thread(target=server.serve_forever, name='scanner-ipc')
+    t.daemon = True
+    t.start()
+    log.debug('Sharing %s with scanner processes on %s:%d', ', '.join(sorted(names)), *server.address)
+    return server.address, authkey, names
+
+
+def connect(address, authkey, names):
+    # Proxies for the shared objects, None for the ones that aren't
+    for name in names:
+        ScannerManager.register(name)
+    manager = ScannerManager(address, authkey)
+    manager.connect()
+    proxies = dict.fromkeys(SHARED)
+    proxies.update((name, getattr(manager, name)()) for name in names)
+    return proxies
+
+
+def start_process(process):
+    # Forking while another thread holds a logging lock would leave the
+    # child stuck on it forever, so hold them all ourselves until it's done
+    handlers = logging.getLogger().handlers
+    logging._acquireLock()
+    try:
+        for handler in handlers:
+            handler.acquire()
+        try:
+            process.start()
+        finally:
+            for handler in handlers:
+                handler.release()
+    finally:
+        logging._releaseLock()
@@ -2,49 +2,138 @@
 # -*- coding: utf-8 -*-
 import logging
 import calendar
+import math
 import sys
 import gc
 import time
 import geopy
+import operator
+import xxhash
+import peewee
 from peewee import SqliteDatabase, InsertQuery, \
-    IntegerField, CharField, DoubleField, BooleanField, \
+    IntegerField, BigIntegerField, CharField, DoubleField, BooleanField, \
     DateTimeField, fn, DeleteQuery, CompositeKey, FloatField, SQL, TextField
 from playhouse.flask_utils import FlaskDB
-from playhouse.pool import PooledMySQLDatabase
+from playhouse.pool import PooledMySQLDatabase, PooledPostgresqlDatabase
 from playhouse.shortcuts import RetryOperationalError
-from playhouse.migrate import migrate, MySQLMigrator, SqliteMigrator
+from playhouse.migrate import migrate, MySQLMigrator, PostgresqlMigrator, SqliteMigrator
 from datetime import datetime, timedelta
-from base64 import b64encode
+from collections import OrderedDict
+from threading import Lock
+from base64 import b64encode, b64decode
+from cStringIO import StringIO
 
 from . import config
 from .utils import get_pokemon_name, get_pokemon_rarity, get_pokemon_types, get_args
-from .transform import transform_from_wgs_to_gcj, get_new_coords
+from .transform import transform_from_wgs_to_gcj, get_new_coords, get_cell_id, get_cell_ranges, local_xy
 from .customLog import printPokemon
+from .queues import row_key
 
 log = logging.getLogger(__name__)
 
 args = get_args()
 flaskDb = FlaskDB()
 
-db_schema_version = 7
+db_schema_version = 9
+
+# PostgreSQL upserts of at least this many rows are loaded with COPY
+copy_threshold = 1000
+
+# Tries at writing a batch of gym snapshots before it is dropped, and the
+# seconds to wait after the first failed one, doubling every time
+gym_snapshot_attempts = 5
+gym_snapshot_backoff = 0.5
+
+# Most parameters a single statement may have (SQLite's default limit)
+max_sql_params = 999
+
+# Versions keys holding the state of each migration step
+MIGRATION_PREFIX = 'migration:'
+MIGRATION_DONE = -1
 
 
 class MyRetryDB(RetryOperationalError, PooledMySQLDatabase):
     pass
 
 
+class MyRetryPostgresDB(RetryOperationalError, PooledPostgresqlDatabase):
+    pass
+
+
+class UBigIntegerField(BigIntegerField):
+    # Unsigned 64 bit integers, stored as a signed BIGINT (two's complement)
+    # because SQLite has no unsigned type.
+    def db_value(self, value):
+        if value is None:
+            return None
+        value = long(value)
+        return value - 2 ** 64 if value >= 2 ** 63 else value
+
+    def python_value(self, value):
+        if value is None:
+            return None
+        return value + 2 ** 64 if value < 0 else value
+
+
+class SpawnpointIdField(UBigIntegerField):
+    # Spawnpoint ids are S2 cell tokens, i.e. a cell id in hex with the
+    # trailing zeros stripped, so they convert to an integer and back exactly.
+    def db_value(self, value):
+        if isinstance(value, basestring):
+            value = int(value.ljust(16, '0'), 16)
+        return super(SpawnpointIdField, self).db_value(value)
+
+    def python_value(self, value):
+        value = super(SpawnpointIdField, self).python_value(value)
+        if value is None:
+            return None
+        return '{:016x}'.format(value).rstrip('0')
+
+
+class HashedIdField(UBigIntegerField):
+    # Fort ids are 128 bit values in hex, too big for an integer column, so
+    # they are stored as their 64 bit xxhash. This is one way: queries can
+    # still be made with the original string, but results return the hash.
+    def db_value(self, value):
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+        if isinstance(value, str):
+            value = xxhash.xxh64(value).intdigest()
+        return super(HashedIdField, self).db_value(value)
+
+
 def init_database(app):
     if args.db_type == 'mysql':
-        log.info('Connecting to MySQL database on %s:%i', args.db_host, args.db_port)
+        port = args.db_port or 3306
+        log.info('Connecting to MySQL database on %s:%i', args.db_host, port)
         connections = args.db_max_connections
-        if hasattr(args, 'accounts'):
+        if getattr(args, 'accounts', None):
             connections *= len(args.accounts)
         db = MyRetryDB(
             args.db_name,
             user=args.db_user,
             password=args.db_pass,
             host=args.db_host,
-            port=args.db_port,
+            port=port,
+            max_connections=connections,
+            stale_timeout=300)
+    elif args.db_type == 'postgres':
+        # peewee only imports the driver if it's installed
+        if not peewee.psycopg2:
+            log.critical("It seems `psycopg2` is not installed. You must run pip install psycopg2 to use PostgreSQL")
+            sys.exit(1)
+
+        port = args.db_port or 5432
+        log.info('Connecting to PostgreSQL database on %s:%i', args.db_host, port)
+        connections = args.db_max_connections
+        if getattr(args, 'accounts', None):
+            connections *= len(args.accounts)
+        db = MyRetryPostgresDB(
+            args.db_name,
+            user=args.db_user,
+            password=args.db_pass,
+            host=args.db_host,
+            port=port,
             max_connections=connections,
             stale_timeout=300)
     else:
@@ -57,6 +146,14 @@ def init_database(app):
     return db
 
 
+def cell_range(field, swLat, swLng, neLat, neLng):
+    # Bounding boxes on (latitude, longitude) can only use the first column of
+    # the index, so also limit the query to the ranges of the S2 cells covering
+    # the box, which the cellid index can answer directly
+    ranges = get_cell_ranges(float(swLat), float(swLng), float(neLat), float(neLng))
+    return reduce(operator.or_, [field.between(low, high) for low, high in ranges])
+
+
 class BaseModel(flaskDb.Model):
 
     @classmethod
@@ -72,13 +169,17 @@ class BaseModel(flaskDb.Model):
 
 class Pokemon(BaseModel):
     # We are base64 encoding the ids delivered by the api
-    # because they are too big for sqlite to handle
-    encounter_id = CharField(primary_key=True, max_length=50)
-    spawnpoint_id = CharField(index=True)
+    # because they are too big for sqlite to handle,
+    # unless --compact-ids stores them as 64 bit integers
+    encounter_id = (UBigIntegerField(primary_key=True) if args.compact_ids
+                    else CharField(primary_key=True, max_length=50))
+    spawnpoint_id = (SpawnpointIdField(index=True) if args.compact_ids
+                     else CharField(index=True))
     pokemon_id = IntegerField(index=True)
     latitude = DoubleField()
     longitude = DoubleField()
     disappear_time = DateTimeField(index=True)
+    cellid = UBigIntegerField(null=True, index=True)
 
     class Meta:
         indexes = ((('latitude', 'longitude'), False),)
@@ -86,18 +187,19 @@ class Pokemon(BaseModel):
     @staticmethod
     def get_active(swLat, swLng, neLat, neLng):
         if swLat is None or swLng is None or neLat is None or neLng is None:
-            query = (Pokemon
+            query = (ActivePokemon
                      .select()
-                     .where(Pokemon.disappear_time > datetime.utcnow())
+                     .where(ActivePokemon.disappear_time > datetime.utcnow())
                      .dicts())
         else:
-            query = (Pokemon
+            query = (ActivePokemon
                      .select()
-                     .where((Pokemon.disappear_time > datetime.utcnow()) &
-                            (((Pokemon.latitude >= swLat) &
-                              (Pokemon.longitude >= swLng) &
-                              (Pokemon.latitude <= neLat) &
-                              (Pokemon.longitude <= neLng))))
+                     .where((ActivePokemon.disappear_time > datetime.utcnow()) &
+                            cell_range(ActivePokemon.cellid, swLat, swLng, neLat, neLng) &
+                            (((ActivePokemon.latitude >= swLat) &
+                              (ActivePokemon.longitude >= swLng) &
+                              (ActivePokemon.latitude <= neLat) &
+                              (ActivePokemon.longitude <= neLng))))
                      .dicts())
 
         # Performance: Disable the garbage collector prior to creating a (potentially) large dict with append()
@@ -121,20 +223,21 @@ class Pokemon(BaseModel):
     @staticmethod
     def get_active_by_id(ids, swLat, swLng, neLat, neLng):
         if swLat is None or swLng is None or neLat is None or neLng is None:
-            query = (Pokemon
+            query = (ActivePokemon
                      .select()
-                     .where((Pokemon.pokemon_id << ids) &
-                            (Pokemon.disappear_time > datetime.utcnow()))
+                     .where((ActivePokemon.pokemon_id << ids) &
+                            (ActivePokemon.disappear_time > datetime.utcnow()))
                      .dicts())
         else:
-            query = (Pokemon
+            query = (ActivePokemon
                      .select()
-                     .where((Pokemon.pokemon_id << ids) &
-                            (Pokemon.disappear_time > datetime.utcnow()) &
-                            (Pokemon.latitude >= swLat) &
-                            (Pokemon.longitude >= swLng) &
-                            (Pokemon.latitude <= neLat) &
-                            (Pokemon.longitude <= neLng))
+                     .where((ActivePokemon.pokemon_id << ids) &
+                            (ActivePokemon.disappear_time > datetime.utcnow()) &
+                            cell_range(ActivePokemon.cellid, swLat, swLng, neLat, neLng) &
+                            (ActivePokemon.latitude >= swLat) &
+                            (ActivePokemon.longitude >= swLng) &
+                            (ActivePokemon.latitude <= neLat) &
+                            (ActivePokemon.longitude <= neLng))
                      .dicts())
 
         # Performance: Disable the garbage collector prior to creating a (potentially) large dict with append()
@@ -227,7 +330,8 @@ class Pokemon(BaseModel):
 
         if None not in (northBoundary, southBoundary, westBoundary, eastBoundary):
             query = (query
-                     .where((Pokemon.latitude <= northBoundary) &
+                     .where(cell_range(Pokemon.cellid, southBoundary, westBoundary, northBoundary, eastBoundary) &
+                            (Pokemon.latitude <= northBoundary) &
                             (Pokemon.latitude >= southBoundary) &
                             (Pokemon.longitude >= westBoundary) &
                             (Pokemon.longitude <= eastBoundary)
@@ -269,13 +373,14 @@ class Pokemon(BaseModel):
                          ((Pokemon.disappear_time.minute * 60) + Pokemon.disappear_time.second).alias('time'),
                          Pokemon.spawnpoint_id
                          ))
-        query = (query.where((Pokemon.latitude <= n) &
+        query = (query.where(cell_range(Pokemon.cellid, s, w, n, e) &
+                             (Pokemon.latitude <= n) &
                              (Pokemon.latitude >= s) &
                              (Pokemon.longitude >= w) &
                              (Pokemon.longitude <= e)
                              ))
         # Sqlite doesn't support distinct on columns
-        if args.db_type == 'mysql':
+        if args.db_type in ('mysql', 'postgres'):
             query = query.distinct(Pokemon.spawnpoint_id)
         else:
             query = query.group_by(Pokemon.spawnpoint_id)
@@ -286,32 +391,47 @@ class Pokemon(BaseModel):
         # steps - 1 to account for the center circle then add 70 for the edge
         step_distance = ((steps - 1) * 121.2436) + 70
         # Compare spawnpoint list to a circle with radius steps * 120
-        # Uses the direct geopy distance between the center and the spawnpoint.
+        # Distances on a plane projected around the center are good to well
+        # under a meter here, so only spawnpoints right on the edge of the
+        # circle need the exact geopy distance.
         filtered = []
 
-        for idx, sp in enumerate(s):
-            if geopy.distance.distance(center, (sp['lat'], sp['lng'])).meters <= step_distance:
-                filtered.append(s[idx])
+        for sp in s:
+            x, y = local_xy(center, sp['lat'], sp['lng'])
+            distance = math.hypot(x, y)
+            if distance > step_distance + 1:
+                continue
+            if distance > step_distance - 1 and geopy.distance.distance(center, (sp['lat'], sp['lng'])).meters > step_distance:
+                continue
 
-        # at this point, 'time' is DISAPPEARANCE time, we're going to morph it to APPEARANCE time
-        for location in filtered:
+            # at this point, 'time' is DISAPPEARANCE time, we're going to morph it to APPEARANCE time
             # examples: time    shifted
             #           0       (   0 + 2700) = 2700 % 3600 = 2700 (0th minute to 45th minute, 15 minutes prior to appearance as time wraps around the hour)
             #           1800    (1800 + 2700) = 4500 % 3600 =  900 (30th minute, moved to arrive at 15th minute)
             # todo: this DOES NOT ACCOUNT for pokemons that appear sooner and live longer, but you'll _always_ have at least 15 minutes, so it works well enough
-            location['time'] = cls.get_spawn_time(location['time'])
+            sp['time'] = cls.get_spawn_time(sp['time'])
+            filtered.append(sp)
 
         return filtered
 
 
+class ActivePokemon(Pokemon):
+    # Copy of the Pokemon rows that haven't disappeared yet. The map polls for
+    # active pokemon all the time; reading them from this small table keeps
+    # that query cheap no matter how much history Pokemon holds.
+    pass
+
+
 class Pokestop(BaseModel):
-    pokestop_id = CharField(primary_key=True, max_length=50)
+    pokestop_id = (HashedIdField(primary_key=True) if args.compact_ids
+                   else CharField(primary_key=True, max_length=50))
     enabled = BooleanField()
     latitude = DoubleField()
     longitude = DoubleField()
     last_modified = DateTimeField(index=True)
     lure_expiration = DateTimeField(null=True, index=True)
     active_fort_modifier = CharField(max_length=50, null=True)
+    cellid = UBigIntegerField(null=True, index=True)
 
     class Meta:
         indexes = ((('latitude', 'longitude'), False),)
@@ -325,7 +445,8 @@ class Pokestop(BaseModel):
         else:
             query = (Pokestop
                      .select()
-                     .where((Pokestop.latitude >= swLat) &
+                     .where(cell_range(Pokestop.cellid, swLat, swLng, neLat, neLng) &
+                            (Pokestop.latitude >= swLat) &
                             (Pokestop.longitude >= swLng) &
                             (Pokestop.latitude <= neLat) &
                             (Pokestop.longitude <= neLng))
@@ -353,7 +474,8 @@ class Gym(BaseModel):
     TEAM_VALOR = 2
     TEAM_INSTINCT = 3
 
-    gym_id = CharField(primary_key=True, max_length=50)
+    gym_id = (HashedIdField(primary_key=True) if args.compact_ids
+              else CharField(primary_key=True, max_length=50))
     team_id = IntegerField()
     guard_pokemon_id = IntegerField()
     gym_points = IntegerField()
@@ -362,6 +484,7 @@ class Gym(BaseModel):
     longitude = DoubleField()
     last_modified = DateTimeField(index=True)
     last_scanned = DateTimeField(default=datetime.utcnow)
+    cellid = UBigIntegerField(null=True, index=True)
 
     class Meta:
         indexes = ((('latitude', 'longitude'), False),)
@@ -375,7 +498,8 @@ class Gym(BaseModel):
         else:
             results = (Gym
                        .select()
-                       .where((Gym.latitude >= swLat) &
+                       .where(cell_range(Gym.cellid, swLat, swLng, neLat, neLng) &
+                              (Gym.latitude >= swLat) &
                               (Gym.longitude >= swLng) &
                               (Gym.latitude <= neLat) &
                               (Gym.longitude <= neLng))
@@ -432,16 +556,21 @@ class ScannedLocation(BaseModel):
     latitude = DoubleField()
     longitude = DoubleField()
     last_modified = DateTimeField(index=True)
+    cellid = UBigIntegerField(null=True, index=True)
 
     class Meta:
         primary_key = CompositeKey('latitude', 'longitude')
 
     @staticmethod
     def get_recent(swLat, swLng, neLat, neLng):
+        if swLat is None or swLng is None or neLat is None or neLng is None:
+            return []
+
         query = (ScannedLocation
                  .select()
                  .where((ScannedLocation.last_modified >=
                         (datetime.utcnow() - timedelta(minutes=15))) &
+                        cell_range(ScannedLocation.cellid, swLat, swLng, neLat, neLng) &
                         (ScannedLocation.latitude >= swLat) &
                         (ScannedLocation.longitude >= swLng) &
                         (ScannedLocation.latitude <= neLat) &
@@ -494,7 +623,8 @@ class Versions(flaskDb.Model):
 
 
 class GymMember(BaseModel):
-    gym_id = CharField(index=True)
+    gym_id = (HashedIdField(index=True) if args.compact_ids
+              else CharField(index=True))
     pokemon_uid = CharField()
     last_scanned = DateTimeField(default=datetime.utcnow)
 
@@ -530,13 +660,75 @@ class Trainer(BaseModel):
 
 
 class GymDetails(BaseModel):
-    gym_id = CharField(primary_key=True, max_length=50)
+    gym_id = (HashedIdField(primary_key=True) if args.compact_ids
+              else CharField(primary_key=True, max_length=50))
     name = CharField()
     description = TextField(null=True, default="")
     url = CharField()
     last_scanned = DateTimeField(default=datetime.utcnow)
 
 
+class GymSnapshot(object):
+    # Not a table: db queue entries of (GymSnapshot, {gym_id: snapshot}) hold
+    # a gym's details and members as parse_gyms found them, see
+    # upsert_gym_snapshots.
+    pass
+
+
+class GymScanCache(object):
+    '''
+    When each gym's details were last scanned, shared by all search workers so
+    they can decide which gyms need their details requested without querying
+    GymDetails. Entries are set as soon as a snapshot is queued, so workers read
+    their own writes, and again when it is committed.
+
+    Holds at most size gyms, evicting the least recently used. A gym that isn't
+    in the cache is treated as never scanned.
+    '''
+
+    def __init__(self, size):
+        self.lock = Lock()
+        self.size = size
+        self.scans = OrderedDict()
+
+    def key(self, gym_id):
+        # Store ids the way the database does, so lookups with the string ids
+        # from the map match entries loaded from compact id tables.
+        return GymDetails.gym_id.db_value(gym_id)
+
+    def get(self, gym_id):
+        key = self.key(gym_id)
+        with self.lock:
+            last_scanned = self.scans.pop(key, None)
+            if last_scanned is not None:
+                self.scans[key] = last_scanned
+            return last_scanned
+
+    def set(self, gym_id, last_scanned):
+        key = self.key(gym_id)
+        with self.lock:
+            # An older snapshot can be committed after a newer one was queued
+            last_scanned = max(last_scanned, self.scans.pop(key, last_scanned))
+            self.scans[key] = last_scanned
+            while len(self.scans) > self.size:
+                self.scans.popitem(last=False)
+
+    def warm(self):
+        query = (GymDetails
+                 .select(GymDetails.gym_id, GymDetails.last_scanned)
+                 .order_by(GymDetails.last_scanned.desc())
+                 .limit(self.size)
+                 .tuples())
+
+        # Oldest first, so the most recently scanned gyms are the last to be evicted
+        for gym_id, last_scanned in reversed(list(query)):
+            self.set(gym_id, last_scanned)
+        log.info('Loaded the last scan time of %d gyms', len(self.scans))
+
+
+gym_cache = GymScanCache(args.gym_cache_size)
+
+
 def hex_bounds(center, steps):
     # Make a box that is (70m * step_limit * 2) + 70m away from the center point
     # Rationale is that you need to travel
@@ -571,12 +763,13 @@ def parse_map(args, map_dict, step_location, db_update_queue, wh_update_queue):
                 printPokemon(p['pokemon_data']['pokemon_id'], p['latitude'],
                              p['longitude'], d_t)
                 pokemons[p['encounter_id']] = {
-                    'encounter_id': b64encode(str(p['encounter_id'])),
+                    'encounter_id': p['encounter_id'] if args.compact_ids else b64encode(str(p['encounter_id'])),
                     'spawnpoint_id': p['spawn_point_id'],
                     'pokemon_id': p['pokemon_data']['pokemon_id'],
                     'latitude': p['latitude'],
                     'longitude': p['longitude'],
-                    'disappear_time': d_t
+                    'disappear_time': d_t,
+                    'cellid': get_cell_id(p['latitude'], p['longitude'])
                 }
 
                 if args.webhooks:
@@ -618,7 +811,8 @@ def parse_map(args, map_dict, step_location, db_update_queue, wh_update_queue):
                     'last_modified': datetime.utcfromtimestamp(
                         f['last_modified_timestamp_ms'] / 1000.0),
                     'lure_expiration': lure_expiration,
-                    'active_fort_modifier': active_fort_modifier
+                    'active_fort_modifier': active_fort_modifier,
+                    'cellid': get_cell_id(f['latitude'], f['longitude'])
                 }
 
                 # Send all pokéstops to webhooks
@@ -638,7 +832,7 @@ def parse_map(args, map_dict, step_location, db_update_queue, wh_update_queue):
                         'last_modified': calendar.timegm(pokestops[f['id']]['last_modified'].timetuple()),
                         'lure_expiration': l_e,
                         'active_fort_modifier': active_fort_modifier
-                    }))
+                    }), low_priority=True)
 
             elif config['parse_gyms'] and f.get('type') is None:  # Currently, there are only stops and gyms
                 gyms[f['id']] = {
@@ -651,6 +845,7 @@ def parse_map(args, map_dict, step_location, db_update_queue, wh_update_queue):
                     'longitude': f['longitude'],
                     'last_modified': datetime.utcfromtimestamp(
                         f['last_modified_timestamp_ms'] / 1000.0),
+                    'cellid': get_cell_id(f['latitude'], f['longitude'])
                 }
 
                 # Send gyms to webhooks
@@ -666,7 +861,7 @@ def parse_map(args, map_dict, step_location, db_update_queue, wh_update_queue):
                         'latitude': f['latitude'],
                         'longitude': f['longitude'],
                         'last_modified': calendar.timegm(gyms[f['id']]['last_modified'].timetuple())
-                    }))
+                    }), low_priority=True)
 
     if len(pokemons):
         db_update_queue.put((Pokemon, pokemons))
@@ -680,34 +875,41 @@ def parse_map(args, map_dict, step_location, db_update_queue, wh_update_queue):
              len(pokestops),
              len(gyms))
 
-    db_update_queue.put((ScannedLocation, {0: {
+    # Scanned locations are only cosmetic, so they are the first thing to go under backpressure
+    if not db_update_queue.put((ScannedLocation, {0: {
         'latitude': step_location[0],
         'longitude': step_location[1],
-        'last_modified': datetime.utcnow()
-    }}))
+        'last_modified': datetime.utcnow(),
+        'cellid': get_cell_id(step_location[0], step_location[1])
+    }}), low_priority=True):
+        log.debug('DB queue is full, dropped scanned location %f/%f', step_location[0], step_location[1])
 
     return {
         'count': len(pokemons) + len(pokestops) + len(gyms),
         'gyms': gyms,
+        'encounters': pokemons.keys(),
     }
 
 
-def parse_gyms(args, gym_responses, wh_update_queue):
-    gym_details = {}
-    gym_members = {}
+def parse_gyms(args, gym_responses, wh_update_queue, db_update_queue):
+    snapshots = {}
     gym_pokemon = {}
     trainers = {}
+    num_members = 0
 
-    i = 0
     for g in gym_responses.values():
         gym_state = g['gym_state']
         gym_id = gym_state['fort_data']['id']
 
-        gym_details[gym_id] = {
-            'gym_id': gym_id,
-            'name': g['name'],
-            'description': g.get('description'),
-            'url': g['urls'][0],
+        snapshot = snapshots[gym_id] = {
+            'details': {
+                'gym_id': gym_id,
+                'name': g['name'],
+                'description': g.get('description'),
+                'url': g['urls'][0],
+                'last_scanned': datetime.utcnow(),
+            },
+            'members': [],
         }
 
         if args.webhooks:
@@ -723,12 +925,12 @@ def parse_gyms(args, gym_responses, wh_update_queue):
             }
 
         for member in gym_state.get('memberships', []):
-            gym_members[i] = {
+            snapshot['members'].append({
                 'gym_id': gym_id,
                 'pokemon_uid': member['pokemon_data']['id'],
-            }
+            })
 
-            gym_pokemon[i] = {
+            gym_pokemon[member['pokemon_data']['id']] = {
                 'pokemon_uid': member['pokemon_data']['id'],
                 'pokemon_id': member['pokemon_data']['pokemon_id'],
                 'cp': member['pokemon_data']['cp'],
@@ -748,7 +950,7 @@ def parse_gyms(args, gym_responses, wh_update_queue):
                 'last_seen': datetime.utcnow(),
             }
 
-            trainers[i] = {
+            trainers[member['trainer_public_profile']['name']] = {
                 'name': member['trainer_public_profile']['name'],
                 'team': gym_state['fort_data']['owned_by_team'],
                 'level': member['trainer_public_profile']['level'],
@@ -776,35 +978,59 @@ def parse_gyms(args, gym_responses, wh_update_queue):
                     'trainer_level': member['trainer_public_profile']['level'],
                 })
 
-            i += 1
+            num_members += 1
         if args.webhooks:
-            wh_update_queue.put(('gym_details', webhook_data))
-
-    # All this database stuff is synchronous (not using the upsert queue) on purpose.
-    # Since the search workers load the GymDetails model from the database to determine if a gym
-    # needs rescanned, we need to be sure the GymDetails get fully committed to the database before moving on.
-    #
-    # We _could_ synchronously upsert GymDetails, then queue the other tables for
-    # upsert, but that would put that Gym's overall information in a weird non-atomic state.
-
-    # upsert all the models
-    if len(gym_details):
-        bulk_upsert(GymDetails, gym_details)
-    if len(gym_pokemon):
-        bulk_upsert(GymPokemon, gym_pokemon)
-    if len(trainers):
-        bulk_upsert(Trainer, trainers)
-
-    # This needs to be completed in a transaction, because we don't wany any other thread or process
-    # to mess with the GymMembers for the gyms we're updating while we're updating the bridge table.
-    with flaskDb.database.transaction():
-        # get rid of all the gym members, we're going to insert new records
-        if len(gym_details):
-            DeleteQuery(GymMember).where(GymMember.gym_id << gym_details.keys()).execute()
-
-        # insert new gym members
-        if len(gym_members):
-            bulk_upsert(GymMember, gym_members)
+            wh_update_queue.put(('gym_details', webhook_data), low_priority=True)
+
+        gym_cache.set(gym_id, snapshot['details']['last_scanned'])
+
+    # Gym pokemon and trainers can turn up in more than one gym, so they are
+    # sharded by their own keys like any other row: two db threads never
+    # upsert the same one. Each gym's details and members are written
+    # together by a db thread, so the search worker can get back to scanning.
+    if gym_pokemon:
+        db_update_queue.put((GymPokemon, gym_pokemon))
+        db_update_queue.put((Trainer, trainers))
+    db_update_queue.put((GymSnapshot, snapshots))
+
+    log.info('Queued %d gyms and %d gym members',
+             len(snapshots),
+             num_members)
+
+
+def upsert_gym_snapshots(snapshots):
+    gym_details = {}
+    gym_members = []
+    for gym_id, snapshot in snapshots.iteritems():
+        gym_details[gym_id] = snapshot['details']
+        gym_members.extend(snapshot['members'])
+
+    # A gym is written as a whole or not at all, we don't want any other thread
+    # or process to see a gym's new details with its old members.
+    # Only locks, deadlocks and lost connections are worth another try; the
+    # db_updater thread has the rest of its shard waiting behind this.
+    for attempt in range(1, gym_snapshot_attempts + 1):
+        try:
+            with flaskDb.database.transaction():
+                upsert_chunks(GymDetails, gym_details.values())
+
+                # get rid of all the gym members, we're going to insert new records
+                DeleteQuery(GymMember).where(GymMember.gym_id << gym_details.keys()).execute()
+                upsert_chunks(GymMember, gym_members)
+            break
+        except peewee.OperationalError as e:
+            if attempt == gym_snapshot_attempts:
+                log.error('Dropping %d gym snapshots after %d attempts: %s', len(gym_details), attempt, e)
+                return
+            delay = gym_snapshot_backoff * 2 ** (attempt - 1)
+            log.warning('%s... Retrying in %g seconds', e, delay)
+            time.sleep(delay)
+        except Exception as e:
+            log.exception('Dropping %d gym snapshots: %s', len(gym_details), e)
+            return
+
+    for gym_id, details in gym_details.iteritems():
+        gym_cache.set(gym_id, details['last_scanned'])
 
     log.info('Upserted %d gyms and %d gym members',
              len(gym_details),
@@ -826,7 +1052,12 @@ def db_updater(args, q):
             # Loop the queue
             while True:
                 model, data = q.get()
-                bulk_upsert(model, data)
+                if model is GymSnapshot:
+                    upsert_gym_snapshots(data)
+                else:
+                    bulk_upsert(model, data)
+                if model is Pokemon:
+                    bulk_upsert(ActivePokemon, data)
                 q.task_done()
                 log.debug('Upserted to %s, %d records (upsert queue remaining: %d)',
                           model.__name__,
@@ -861,6 +1092,12 @@ def clean_db_loop(args):
                              (datetime.utcnow() - timedelta(minutes=30)))))
             query.execute()
 
+            # Expired pokemon only live on in the history table
+            query = (ActivePokemon
+                     .delete()
+                     .where(ActivePokemon.disappear_time < datetime.utcnow()))
+            query.execute()
+
             # Remove active modifier from expired lured pokestops
             query = (Pokestop
                      .update(lure_expiration=None)
@@ -881,14 +1118,28 @@ def clean_db_loop(args):
 
 
 def bulk_upsert(cls, data):
-    num_rows = len(data.values())
+    rows = data.values()
+
+    if args.db_type == 'postgres':
+        # A row can only be updated once per statement, keep the latest copy
+        rows = dict((row_key(cls, key, row), row) for key, row in data.iteritems()).values()
+        if len(rows) >= copy_threshold:
+            while True:
+                log.debug('Copying %d items', len(rows))
+                try:
+                    copy_upsert(cls, rows)
+                    return
+                except Exception as e:
+                    log.warning('%s... Retrying', e)
+
+    num_rows = len(rows)
     i = 0
     step = 120
 
     while i < num_rows:
         log.debug('Inserting items %d to %d', i, min(i + step, num_rows))
         try:
-            InsertQuery(cls, rows=data.values()[i:min(i + step, num_rows)]).upsert().execute()
+            upsert(cls, rows[i:min(i + step, num_rows)])
         except Exception as e:
             log.warning('%s... Retrying', e)
             continue
@@ -896,16 +1147,90 @@ def bulk_upsert(cls, data):
         i += step
 
 
+def upsert_chunks(cls, rows, step=120):
+    # Unlike bulk_upsert this doesn't retry, so it can be used in a transaction
+    for i in range(0, len(rows), step):
+        upsert(cls, rows[i:i + step])
+
+
+def upsert(cls, rows):
+    # MySQL and SQLite have REPLACE INTO, PostgreSQL needs an ON CONFLICT clause
+    query = InsertQuery(cls, rows=rows)
+    if args.db_type != 'postgres':
+        return query.upsert().execute()
+
+    sql, params = query.sql()
+    columns = [cls._meta.fields[name].db_column for name in rows[0]]
+    return cls._meta.database.execute_sql(sql + on_conflict(cls, columns), params)
+
+
+def on_conflict(cls, columns):
+    quote = cls._meta.database.quote_char
+    pk_columns = [f.db_column for f in cls._meta.get_primary_key_fields()] if cls._meta.primary_key else []
+    if not pk_columns:
+        return ''
+
+    target = ', '.join(quote + c + quote for c in pk_columns)
+    updates = ', '.join('{0}{1}{0} = EXCLUDED.{0}{1}{0}'.format(quote, c) for c in columns if c not in pk_columns)
+    if not updates:
+        return ' ON CONFLICT ({}) DO NOTHING'.format(target)
+    return ' ON CONFLICT ({}) DO UPDATE SET {}'.format(target, updates)
+
+
+def copy_value(value):
+    # Encode a value for COPY's text format
+    if value is None:
+        return '\\N'
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+    if isinstance(value, float):
+        value = repr(value)
+    elif isinstance(value, datetime):
+        value = value.isoformat()
+    elif isinstance(value, unicode):
+        value = value.encode('utf-8')
+    else:
+        value = str(value)
+    return value.replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+
+def copy_upsert(cls, rows):
+    # Stream the rows into a temporary table with COPY, which is far cheaper
+    # than parsing huge multi-row INSERTs, then merge them in one statement.
+    db = cls._meta.database
+    quote = db.quote_char
+    fields = [cls._meta.fields[name] for name in rows[0]]
+    columns = ', '.join(quote + f.db_column + quote for f in fields)
+    table = quote + cls._meta.db_table + quote
+    temp = quote + cls._meta.db_table + '_copy' + quote
+
+    data = StringIO()
+    for row in rows:
+        data.write('\t'.join(copy_value(f.db_value(row.get(f.name))) for f in fields) + '\n')
+    data.seek(0)
+
+    with db.atomic():
+        cursor = db.get_cursor()
+        cursor.execute('CREATE TEMPORARY TABLE {} (LIKE {} INCLUDING DEFAULTS) ON COMMIT DROP'.format(temp, table))
+        cursor.copy_expert('COPY {} ({}) FROM STDIN'.format(temp, columns), data)
+        cursor.execute('INSERT INTO {0} ({1}) SELECT {1} FROM {2}'.format(table, columns, temp) +
+                       on_conflict(cls, [f.db_column for f in fields]))
+
+
 def create_tables(db):
     db.connect()
-    db.create_tables([Pokemon, Pokestop, Gym, ScannedLocation, GymDetails, GymMember, GymPokemon, Trainer, MainWorker, WorkerStatus], safe=True)
+    if not Versions.table_exists() and not ScannedLocation.table_exists():
+        # A brand new database starts out with the current schema
+        db.create_tables([Versions])
+        InsertQuery(Versions, rows=[{Versions.key: 'schema_version', Versions.val: db_schema_version}]).execute()
+    db.create_tables([Pokemon, ActivePokemon, Pokestop, Gym, ScannedLocation, GymDetails, GymMember, GymPokemon, Trainer, MainWorker, WorkerStatus], safe=True)
     verify_database_schema(db)
     db.close()
 
 
 def drop_tables(db):
     db.connect()
-    db.drop_tables([Pokemon, Pokestop, Gym, ScannedLocation, Versions, GymDetails, GymMember, GymPokemon, Trainer, MainWorker, WorkerStatus, Versions], safe=True)
+    db.drop_tables([Pokemon, ActivePokemon, Pokestop, Gym, ScannedLocation, Versions, GymDetails, GymMember, GymPokemon, Trainer, MainWorker, WorkerStatus, Versions], safe=True)
     db.close()
 
 
@@ -917,10 +1242,10 @@ def verify_database_schema(db):
             # Versions table didn't exist, but there were tables. This must mean the user
             # is coming from a database that existed before we started tracking the schema
             # version. Perform a full upgrade.
-            InsertQuery(Versions, {Versions.key: 'schema_version', Versions.val: 0}).execute()
+            InsertQuery(Versions, rows=[{Versions.key: 'schema_version', Versions.val: 0}]).execute()
             database_migrate(db, 0)
         else:
-            InsertQuery(Versions, {Versions.key: 'schema_version', Versions.val: db_schema_version}).execute()
+            InsertQuery(Versions, rows=[{Versions.key: 'schema_version', Versions.val: db_schema_version}]).execute()
 
     else:
         db_ver = Versions.get(Versions.key == 'schema_version').val
@@ -934,53 +1259,306 @@ def verify_database_schema(db):
             log.error("Please upgrade your code base or drop all tables in your database.")
             sys.exit(1)
 
+    verify_compact_ids(db)
 
-def database_migrate(db, old_ver):
-    # Update database schema version
-    Versions.update(val=db_schema_version).where(Versions.key == 'schema_version').execute()
 
-    log.info("Detected database version %i, updating to %i", old_ver, db_schema_version)
-
-    # Perform migrations here
-    migrator = None
+def get_migrator(db):
     if args.db_type == 'mysql':
-        migrator = MySQLMigrator(db)
+        return MySQLMigrator(db)
+    elif args.db_type == 'postgres':
+        return PostgresqlMigrator(db)
     else:
-        migrator = SqliteMigrator(db)
+        return SqliteMigrator(db)
+
+
+def database_migrate(db, old_ver):
+    log.info("Detected database version %i, updating to %i", old_ver, db_schema_version)
+
+    # Perform migrations here. Every step is recorded in Versions once it's
+    # done, so an upgrade that gets interrupted picks up where it left off.
+    migrator = get_migrator(db)
 
 #   No longer necessary, we're doing this at schema 4 as well
 #    if old_ver < 1:
 #        db.drop_tables([ScannedLocation])
 
     if old_ver < 2:
-        migrate(migrator.add_column('pokestop', 'encounter_id', CharField(max_length=50, null=True)))
+        run_migration('v2 pokestop.encounter_id',
+                      migrate, migrator.add_column('pokestop', 'encounter_id', CharField(max_length=50, null=True)))
 
     if old_ver < 3:
-        migrate(
-            migrator.add_column('pokestop', 'active_fort_modifier', CharField(max_length=50, null=True)),
-            migrator.drop_column('pokestop', 'encounter_id'),
-            migrator.drop_column('pokestop', 'active_pokemon_id')
-        )
+        run_migration('v3 pokestop.active_fort_modifier',
+                      migrate, migrator.add_column('pokestop', 'active_fort_modifier', CharField(max_length=50, null=True)))
+        run_migration('v3 drop pokestop.encounter_id',
+                      migrate, migrator.drop_column('pokestop', 'encounter_id'))
+        run_migration('v3 drop pokestop.active_pokemon_id',
+                      migrate, migrator.drop_column('pokestop', 'active_pokemon_id'))
 
     if old_ver < 4:
-        db.drop_tables([ScannedLocation])
+        run_migration('v4 scannedlocation', recreate_tables, db, [ScannedLocation])
 
     if old_ver < 5:
         # Some pokemon were added before the 595 bug was "fixed"
         # Clean those up for a better UX
-        query = (Pokemon
-                 .delete()
-                 .where(Pokemon.disappear_time >
-                        (datetime.utcnow() - timedelta(hours=24))))
-        query.execute()
+        cutoff = datetime.utcnow() - timedelta(hours=24)
+        delete_in_chunks('v5 pokemon cleanup', Pokemon, Pokemon.disappear_time > cutoff)
 
     if old_ver < 6:
-        migrate(
-            migrator.add_column('gym', 'last_scanned', DateTimeField(null=True)),
-        )
+        run_migration('v6 gym.last_scanned',
+                      migrate, migrator.add_column('gym', 'last_scanned', DateTimeField(null=True)))
 
     if old_ver < 7:
-        migrate(
-            migrator.drop_column('gymdetails', 'description'),
-            migrator.add_column('gymdetails', 'description', TextField(null=True, default=""))
-        )
+        run_migration('v7 drop gymdetails.description',
+                      migrate, migrator.drop_column('gymdetails', 'description'))
+        run_migration('v7 gymdetails.description',
+                      migrate, migrator.add_column('gymdetails', 'description', TextField(null=True, default="")))
+
+    if old_ver < 8:
+        # The steps from here on read rows through the models, so the ids
+        # have to be in the format the models declare before they run
+        verify_compact_ids(db)
+
+        # S2 cell ids for the spatial index, filled in for existing rows
+        for model in [Pokemon, Pokestop, Gym, ScannedLocation]:
+            table = model._meta.db_table
+            if 'cellid' not in [c.name for c in db.get_columns(table)]:
+                run_migration('v8 {}.cellid'.format(table),
+                              migrate, migrator.add_column(table, 'cellid', UBigIntegerField(null=True)))
+                run_migration('v8 {}.cellid index'.format(table),
+                              migrate, migrator.add_index(table, ('cellid',), False))
+            backfill_cell_ids(model)
+
+    if old_ver < 9:
+        run_migration('v9 activepokemon', seed_active_pokemon)
+
+    # Update database schema version
+    Versions.update(val=db_schema_version).where(Versions.key == 'schema_version').execute()
+    clear_migrations('v')
+
+
+def seed_active_pokemon():
+    # Fill the new active pokemon table with everything still on the map
+    query = (Pokemon
+             .select()
+             .where(Pokemon.disappear_time > datetime.utcnow())
+             .dicts())
+    bulk_upsert(ActivePokemon, dict(enumerate(query)))
+
+
+def recreate_tables(db, models):
+    db.drop_tables(models, safe=True)
+    db.create_tables(models)
+
+
+def migration_state(name):
+    # None for steps that haven't started, else the number of rows done so far
+    # or MIGRATION_DONE
+    try:
+        return Versions.get(Versions.key == MIGRATION_PREFIX + name).val
+    except Versions.DoesNotExist:
+        return None
+
+
+def set_migration_state(name, val):
+    key = MIGRATION_PREFIX + name
+    if not Versions.update(val=val).where(Versions.key == key).execute():
+        InsertQuery(Versions, rows=[{Versions.key: key, Versions.val: val}]).execute()
+
+
+def migration_pending(prefix):
+    return Versions.select().where(Versions.key.startswith(MIGRATION_PREFIX + prefix)).exists()
+
+
+def clear_migrations(prefix):
+    Versions.delete().where(Versions.key.startswith(MIGRATION_PREFIX + prefix)).execute()
+
+
+def run_migration(name, func, *args):
+    if migration_state(name) == MIGRATION_DONE:
+        log.info('Migration step %s already done, skipping', name)
+        return
+
+    log.info('Running migration step %s', name)
+    func(*args)
+    set_migration_state(name, MIGRATION_DONE)
+
+
+def migrate_in_chunks(name, total, chunk):
+    # Calls chunk() until it returns 0. Each call handles the next batch of
+    # rows in its own transaction and returns how many it did, so the tables
+    # stay usable in between and the step can be resumed at any point.
+    state = migration_state(name)
+    if state == MIGRATION_DONE:
+        log.info('Migration step %s already done, skipping', name)
+        return
+    if state:
+        log.info('Resuming migration step %s after %d rows', name, state)
+
+    done = 0
+    start = time.time()
+    while True:
+        count = chunk()
+        if not count:
+            break
+
+        done += count
+        set_migration_state(name, (state or 0) + done)
+
+        elapsed = time.time() - start
+        remaining = max(total - done, 0) * elapsed / done
+        log.info('%s: %d of %d rows (%d%%), about %s left', name, done, total,
+                 100 * done / max(total, 1), timedelta(seconds=int(remaining)))
+
+    set_migration_state(name, MIGRATION_DONE)
+
+
+def delete_in_chunks(name, model, where, step=1000):
+    # The keys are read and deleted as they are stored, the ids may not be in
+    # the format the model declares yet (compact ids are converted at v8)
+    db = flaskDb.database
+    pk = model._meta.primary_key
+    step = min(step, max_sql_params)
+    delete = 'DELETE FROM {0}{1}{0} WHERE {0}{2}{0} IN '.format(db.quote_char, model._meta.db_table, pk.db_column)
+
+    def chunk():
+        sql, params = model.select(pk).where(where).limit(step).sql()
+        keys = [row[0] for row in db.execute_sql(sql, params).fetchall()]
+        if keys:
+            db.execute_sql(delete + '({})'.format(', '.join([db.interpolation] * len(keys))), keys)
+        return len(keys)
+
+    migrate_in_chunks(name, model.select().where(where).count(), chunk)
+
+
+def backfill_cell_ids(model, step=1000):
+    db = flaskDb.database
+    quote = db.quote_char
+    pk = model._meta.primary_key
+    keys = pk.field_names if isinstance(pk, CompositeKey) else [pk.name]
+    key_columns = [quote + model._meta.fields[key].db_column + quote for key in keys]
+    table = quote + model._meta.db_table + quote
+    cellid = quote + model.cellid.db_column + quote
+
+    # Every row takes its key twice and its cell id once in the update
+    step = min(step, max_sql_params // (2 * len(keys) + 1))
+    columns = key_columns + [quote + field.db_column + quote for field in (model.latitude, model.longitude)]
+    select = 'SELECT {} FROM {} WHERE {} IS NULL LIMIT {}'.format(', '.join(columns), table, cellid, step)
+    match = ' AND '.join('{} = {}'.format(column, db.interpolation) for column in key_columns)
+
+    def chunk():
+        # The cell ids are worked out here, then set with one statement per chunk
+        with db.transaction():
+            rows = db.execute_sql(select).fetchall()
+            if not rows:
+                return 0
+
+            params = []
+            for row in rows:
+                params.extend(row[:-2])
+                params.append(model.cellid.db_value(get_cell_id(row[-2], row[-1])))
+            for row in rows:
+                params.extend(row[:-2])
+
+            db.execute_sql('UPDATE {} SET {} = CASE {} END WHERE {}'.format(
+                table, cellid,
+                ' '.join(['WHEN {} THEN {}'.format(match, db.interpolation)] * len(rows)),
+                ' OR '.join(['({})'.format(match)] * len(rows))), params)
+            return len(rows)
+
+    migrate_in_chunks('v8 {} cell ids'.format(model._meta.db_table),
+                      model.select().where(model.cellid >> None).count(), chunk)
+
+
+def compact_ids_in_use(db):
+    # The type of the encounter_id column tells us which id format the tables were created with
+    for column in db.get_columns(Pokemon._meta.db_table):
+        if column.name == 'encounter_id':
+            return 'int' in column.data_type.lower()
+    return args.compact_ids
+
+
+def verify_compact_ids(db):
+    compact_db = compact_ids_in_use(db)
+    if compact_db == args.compact_ids and not migration_pending('compact ids'):
+        return
+
+    if not args.compact_ids:
+        log.error("Your database stores compact ids, which can't be converted back to strings.")
+        log.error("Please run with --compact-ids or drop all tables in your database.")
+        sys.exit(1)
+
+    migrate_to_compact_ids(db)
+
+
+def migrate_to_compact_ids(db):
+    log.info('Converting database ids to compact integers, this can take a while on a large database')
+    # Marks the conversion as started until every table is done
+    set_migration_state('compact ids', 0)
+
+    for model in [Pokemon, ActivePokemon, Pokestop, Gym, GymMember, GymDetails]:
+        run_migration('compact ids ' + model._meta.db_table, convert_to_compact_ids, db, model)
+
+    clear_migrations('compact ids')
+    log.info('Database ids converted')
+
+
+def convert_to_compact_ids(db, model):
+    migrator = get_migrator(db)
+    table = model._meta.db_table
+    old_table = table + '_old'
+    copy_step = 'compact ids copy ' + table
+
+    # Move the old table out of the way, unless an interrupted run already did
+    if migration_state(copy_step) is None and old_table not in db.get_tables():
+        migrate(migrator.rename_table(table, old_table))
+
+    if old_table in db.get_tables():
+        # SQLite and PostgreSQL index names are global, so the old indexes have to go too
+        for index in db.get_indexes(old_table):
+            if args.db_type == 'postgres' and index.name == table + '_pkey':
+                # The primary key index can't be dropped, only renamed
+                db.execute_sql('ALTER INDEX {0}{1}{0} RENAME TO {0}{2}_pkey{0}'.format(db.quote_char, index.name, old_table))
+            elif index.name != 'PRIMARY' and not index.name.startswith('sqlite_autoindex'):
+                migrate(migrator.drop_index(old_table, index.name))
+
+    # Recreate it with integer ids, then move the rows over
+    db.create_tables([model], safe=True)
+    copy_to_compact_ids(db, old_table, model, copy_step)
+    db.execute_sql('DROP TABLE IF EXISTS {0}{1}{0}'.format(db.quote_char, old_table))
+
+
+def copy_to_compact_ids(db, old_table, model, name, step=1000):
+    quote = db.quote_char
+    # Tables converted while upgrading don't have the columns later migrations add yet
+    old_columns = set(c.name for c in db.get_columns(old_table)) if old_table in db.get_tables() else set()
+    columns = [f.db_column for f in model._meta.sorted_fields if f.db_column in old_columns]
+    # Gym members have no primary key, they are moved a gym at a time
+    key = model._meta.primary_key.db_column if model._meta.primary_key else model.gym_id.db_column
+    table = quote + old_table + quote
+    key_column = quote + key + quote
+
+    def chunk():
+        # Each batch is deleted from the old table in the same transaction it
+        # is copied in, so an interrupted copy carries on with what's left
+        with db.transaction():
+            keys = [row[0] for row in db.execute_sql('SELECT DISTINCT {} FROM {} LIMIT {}'.format(key_column, table, step)).fetchall()]
+            if not keys:
+                return 0
+
+            where = ' WHERE {} IN ({})'.format(key_column, ', '.join([db.interpolation] * len(keys)))
+            select = 'SELECT {} FROM {}'.format(', '.join(quote + c + quote for c in columns), table)
+            rows = [dict(zip(columns, row)) for row in db.execute_sql(select + where, keys).fetchall()]
+
+            if issubclass(model, Pokemon):
+                for row in rows:
+                    row['encounter_id'] = long(b64decode(row['encounter_id']))
+
+            # Forts and spawnpoints still have their string ids here, the fields convert them
+            upsert_chunks(model, rows)
+            db.execute_sql('DELETE FROM {}'.format(table) + where, keys)
+            return len(rows)
+
+    total = 0
+    if old_table in db.get_tables():
+        total = db.execute_sql('SELECT COUNT(*) FROM {}'.format(table)).fetchone()[0]
+    migrate_in_chunks(name, total, chunk)
@@ -2,48 +2,58 @@
 # -*- coding: utf-8 -*-
 
 import logging
+import random
 import requests
 import sys
+import time
 
 from queue import Queue
-from threading import Thread
+from threading import Lock, Thread
 
 log = logging.getLogger(__name__)
 
 
 # Simple function to do a call to Niantic's system for testing proxy connectivity
-def check_proxy(proxy_queue, timeout, proxies):
+# Returns what went wrong, or None when the proxy works
+def test_proxy(proxy, timeout):
 
     proxy_test_url = 'https://sso.pokemon.com/'
-    proxy = proxy_queue.get()
 
-    if proxy and proxy[1]:
+    try:
+        proxy_response = requests.get(proxy_test_url, proxies={'http': proxy, 'https': proxy}, timeout=timeout)
 
-        log.debug('Checking proxy: %s', proxy[1])
+        if proxy_response.status_code == 200:
+            return None
 
-        try:
-            proxy_response = requests.get(proxy_test_url, proxies={'http': proxy[1], 'https': proxy[1]}, timeout=timeout)
+        return "Wrong status code - " + str(proxy_response.status_code)
 
-            if proxy_response.status_code == 200:
-                log.debug('Proxy %s is ok', proxy[1])
-                proxy_queue.task_done()
-                proxies.append(proxy[1])
-                return True
+    except requests.ConnectTimeout:
+        return "Connection timeout (" + str(timeout) + " second(s) ) via proxy " + proxy
 
-            else:
-                proxy_error = "Wrong status code - " + str(proxy_response.status_code)
+    except requests.ConnectionError:
+        return "Failed to connect to proxy " + proxy
 
-        except requests.ConnectTimeout:
-            proxy_error = "Connection timeout (" + str(timeout) + " second(s) ) via proxy " + proxy[1]
+    except Exception as e:
+        return e
 
-        except requests.ConnectionError:
-            proxy_error = "Failed to connect to proxy " + proxy[1]
 
-        except Exception as e:
-            proxy_error = e
+def check_proxy(proxy_queue, timeout, proxies):
+
+    proxy = proxy_queue.get()
+
+    if proxy and proxy[1]:
+
+        log.debug('Checking proxy: %s', proxy[1])
+
+        proxy_error = test_proxy(proxy[1], timeout)
+        if proxy_error is None:
+            log.debug('Proxy %s is ok', proxy[1])
+            proxy_queue.task_done()
+            proxies.append(proxy[1])
+            return True
 
     else:
-            proxy_error = "Empty proxy server"
+        proxy_error = "Empty proxy server"
 
     log.warning('%s', proxy_error)
     proxy_queue.task_done()
@@ -81,3 +91,133 @@ def check_proxies(args):
     else:
         log.info('Proxy check completed with %d working proxies of %d configured', working_proxies, total_proxies)
         return proxies
+
+
+class ProxyPool(object):
+    '''
+    The proxies workers search through. Every account session gets a proxy
+    picked at random, weighted by how fast its requests have been, how many
+    of them fail and how many sessions are using it already.
+
+    A proxy failing more than max_error_rate of its requests is evicted: new
+    sessions don't get it, and the sessions on it move to another proxy
+    before their next scan. Evicted proxies are probed every probe_interval
+    seconds and admitted again once a probe gets through.
+    '''
+
+    # Weight of the latest request in the moving averages
+    ALPHA = 0.2
+    # Requests a proxy gets before it can be evicted, so one bad scan can't do it
+    MIN_REQUESTS = 5
+
+    def __init__(self, proxies, timeout, probe_interval=60, max_error_rate=0.5):
+        self.proxies = list(proxies)
+        self.timeout = timeout
+        self.probe_interval = probe_interval
+        self.max_error_rate = max_error_rate
+        self.stats = dict((proxy, {'latency': None, 'errors': 0.0, 'requests': 0, 'sessions': 0, 'evicted': False})
+                          for proxy in self.proxies)
+        self.lock = Lock()
+
+    def start(self):
+        t = Thread(target=self.probe_evicted, name='proxy-prober')
+        t.daemon = True
+        t.start()
+
+    def acquire(self, current=None, prefer=None):
+        # A proxy for a new session, in place of the current one if there is
+        # one. The preferred proxy, e.g. the one the account logged in
+        # through, is kept unless it has been evicted.
+        with self.lock:
+            self._release(current)
+
+            proxy = prefer
+            if proxy not in self.stats or self.stats[proxy]['evicted']:
+                proxy = self._choose()
+
+            self.stats[proxy]['sessions'] += 1
+            return proxy
+
+    def choose(self):
+        # A proxy to log in through, without starting a session on it
+        with self.lock:
+            return self._choose()
+
+    def release(self, proxy):
+        with self.lock:
+            self._release(proxy)
+
+    def record(self, proxy, latency, ok):
+        # How a request through the proxy went
+        with self.lock:
+            stats = self.stats.get(proxy)
+            if stats is None:
+                return
+
+            stats['requests'] += 1
+            stats['errors'] += self.ALPHA * ((not ok) - stats['errors'])
+            # Failed requests mostly just time out, they say little about speed
+            if ok:
+                if stats['latency'] is None:
+                    stats['latency'] = latency
+                stats['latency'] += self.ALPHA * (latency - stats['latency'])
+
+            if not stats['evicted'] and stats['requests'] >= self.MIN_REQUESTS and stats['errors'] > self.max_error_rate:
+                stats['evicted'] = True
+                log.warning('Evicting proxy %s, %d%% of its requests fail', proxy, stats['errors'] * 100)
+
+    def usable(self, proxy):
+        # False once a session should move off the proxy
+        with self.lock:
+            if proxy not in self.stats or not self.stats[proxy]['evicted']:
+                return True
+            # There's nowhere better to go
+            return all(stats['evicted'] for stats in self.stats.values())
+
+    def status(self):
+        # Every proxy's stats, in the order they were configured
+        with self.lock:
+            return [dict(self.stats[proxy], proxy=proxy) for proxy in self.proxies]
+
+    def probe_evicted(self):
+        while True:
+            time.sleep(self.probe_interval)
+            with self.lock:
+                evicted = [proxy for proxy in self.proxies if self.stats[proxy]['evicted']]
+
+            for proxy in evicted:
+                proxy_error = test_proxy(proxy, self.timeout)
+                if proxy_error is not None:
+                    log.info('Proxy %s is still evicted: %s', proxy, proxy_error)
+                    continue
+
+                log.info('Proxy %s passed its probe, admitting it again', proxy)
+                with self.lock:
+                    self.stats[proxy].update(evicted=False, errors=0.0, requests=0)
+
+    def _choose(self):
+        candidates = [proxy for proxy in self.proxies if not self.stats[proxy]['evicted']]
+        if not candidates:
+            # Rather a bad proxy than none at all
+            candidates = [min(self.proxies, key=lambda proxy: self.stats[proxy]['errors'])]
+
+        weights = [self._weight(proxy) for proxy in candidates]
+        pick = random.uniform(0, sum(weights))
+        for proxy, weight in zip(candidates, weights):
+            pick -= weight
+            if pick <= 0:
+                break
+        return proxy
+
+    def _release(self, proxy):
+        if proxy in self.stats:
+            self.stats[proxy]['sessions'] = max(0, self.stats[proxy]['sessions'] - 1)
+
+    def _weight(self, proxy):
+        stats = self.stats[proxy]
+        latency = stats['latency']
+        if latency is None:
+            # Not measured yet, count it as average
+            measured = [s['latency'] for s in self.stats.values() if s['latency'] is not None]
+            latency = sum(measured) / len(measured) if measured else 1.0
+        return (1.0 - stats['errors']) / (max(latency, 0.01) * (1 + stats['sessions']))
@@ -0,0 +1,560 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import logging
+import math
+import os
+import re
+import struct
+import time
+import cPickle as pickle
+
+from collections import deque
+from heapq import heapify, heappop, heappush
+from itertools import count
+from peewee import CompositeKey
+from queue import Queue, Empty, Full
+from threading import Condition, Lock
+
+from .transform import local_xy
+
+log = logging.getLogger(__name__)
+
+# What producers do once a bounded queue is full: wait for room, throw away
+# low priority items, or wait while search workers slow down their scan rate
+BACKPRESSURE_POLICIES = ('block', 'drop', 'slow')
+
+# A bounded queue counts as saturated once it is this full
+HIGH_WATER = 0.8
+
+# Each spilled record is stored as a 4 byte big endian length followed by the pickled item
+RECORD_HEADER = struct.Struct('!I')
+
+# The spill file's acknowledged offset is saved after this many records, or
+# this many seconds, whichever comes first
+COMMIT_RECORDS = 100
+COMMIT_INTERVAL = 1.0
+# Or as soon as the queue drains, to start over with an empty file, once it's this big
+TRUNCATE_SIZE = 1 << 20
+
+
+def row_key(model, key, row):
+    # Use the row's primary key when the model has one, so the same record
+    # always hashes the same way no matter how the producer keyed the dict.
+    # Entries for things that aren't tables are sharded by their dict key.
+    meta = getattr(model, '_meta', None)
+    if meta is None:
+        return key
+    pk = meta.primary_key
+    if isinstance(pk, CompositeKey):
+        return tuple(row.get(name) for name in pk.field_names)
+    if pk:
+        return row.get(pk.name, key)
+    return key
+
+
+class DbUpdateQueue(object):
+    '''
+    Database update queue partitioned by model and primary key hash.
+
+    Every (model, {key: row}) update is split up so each record lands in the
+    shard owned by its key. Each shard is drained by exactly one db_updater
+    thread, so updates to a given record are always written in the order they
+    were queued and two threads never upsert the same rows at the same time.
+    '''
+
+    def __init__(self, shards=1, spill_dir=None, memory_size=0, maxsize=0, policy='block'):
+        shards = max(1, shards)
+
+        if spill_dir:
+            if not os.path.isdir(spill_dir):
+                os.makedirs(spill_dir)
+            self.shards = [SpillQueue(spill_path(spill_dir, i), memory_size, maxsize, policy) for i in range(shards)]
+            self.adopt_orphans(spill_dir)
+        else:
+            self.shards = [BoundedQueue(maxsize, policy) for i in range(shards)]
+
+    def shard_for(self, model, key, row):
+        return hash((model.__name__, row_key(model, key, row))) % len(self.shards)
+
+    def split(self, item):
+        model, data = item
+
+        if len(self.shards) == 1:
+            return {0: item}
+
+        parts = {}
+        for key, row in data.iteritems():
+            parts.setdefault(self.shard_for(model, key, row), {})[key] = row
+        return dict((shard, (model, part)) for shard, part in parts.iteritems())
+
+    def put(self, item, low_priority=False):
+        queued = True
+        for shard, part in self.split(item).iteritems():
+            queued &= self.shards[shard].put(part, low_priority=low_priority)
+        return queued
+
+    def adopt_orphans(self, spill_dir):
+        # Spill files left behind by a run with more db threads than we have now
+        # get replayed through the regular sharding, then removed
+        for name in sorted(os.listdir(spill_dir)):
+            match = re.match(r'^db-queue-(\d+)\.spill$', name)
+            if not match or int(match.group(1)) < len(self.shards):
+                continue
+
+            orphan = SpillQueue(os.path.join(spill_dir, name), 0)
+            replayed = 0
+            try:
+                while True:
+                    # Nothing is draining the shards yet, so this must not wait for room
+                    for shard, part in self.split(orphan.get_nowait()).iteritems():
+                        self.shards[shard].force_put(part)
+                    orphan.task_done()
+                    replayed += 1
+            except Empty:
+                pass
+            orphan.close()
+            orphan.remove()
+            log.info('Replayed %d db updates from orphaned spill file %s', replayed, name)
+
+    def qsize(self):
+        return sum(self.shard_sizes())
+
+    def saturated(self):
+        return any(q.saturated() for q in self.shards)
+
+    def dropped(self):
+        return sum(q.dropped for q in self.shards)
+
+    def spilled_bytes(self):
+        return sum(getattr(q, 'spilled_bytes', lambda: 0)() for q in self.shards)
+
+    def shard_sizes(self):
+        return [q.qsize() for q in self.shards]
+
+    def empty(self):
+        return self.qsize() == 0
+
+
+class BoundedQueue(Queue):
+    '''
+    Queue with an optional size limit (0 for unbounded) and a backpressure
+    policy. Producers block once the queue is full, except that with the
+    'drop' policy items put with low_priority=True are thrown away instead.
+    '''
+
+    def __init__(self, maxsize=0, policy='block'):
+        Queue.__init__(self, maxsize)
+        self.policy = policy
+        self.dropped = 0
+
+    def put(self, item, block=True, timeout=None, low_priority=False):
+        if low_priority and self.policy == 'drop' and self.maxsize > 0:
+            try:
+                Queue.put(self, item, False)
+            except Full:
+                with self.mutex:
+                    self.dropped += 1
+                return False
+        else:
+            Queue.put(self, item, block, timeout)
+        return True
+
+    def force_put(self, item):
+        # Queue an item even if that takes the queue over its limit
+        with self.mutex:
+            self._put(item)
+            self.unfinished_tasks += 1
+            self.not_empty.notify()
+
+    def saturated(self):
+        return self.maxsize > 0 and self.qsize() >= self.maxsize * HIGH_WATER
+
+    def clear(self):
+        # Throw away everything that's queued, as if it had been processed
+        with self.mutex:
+            removed = self._qsize()
+            self._clear()
+            self._forget(removed)
+
+    def _clear(self):
+        self.queue.clear()
+
+    def _forget(self, removed):
+        if removed:
+            self.unfinished_tasks -= removed
+            if self.unfinished_tasks <= 0:
+                self.unfinished_tasks = 0
+                self.all_tasks_done.notify_all()
+            self.not_full.notify_all()
+
+
+class NotifyingQueue(Queue):
+    '''
+    Queue that sets an event whenever something is put on it, e.g. to wake
+    the overseer up as soon as a new location comes in.
+    '''
+
+    def __init__(self, wakeup, maxsize=0):
+        Queue.__init__(self, maxsize)
+        self.wakeup = wakeup
+
+    def _put(self, item):
+        Queue._put(self, item)
+        self.wakeup.set()
+
+
+class Switch(object):
+    '''
+    A flag like threading.Event, that can also be waited on to be cleared:
+    search control's pause_bit, which paused workers wait on to resume.
+    Flipping it either way sets the wakeup event too, if there is one.
+    '''
+
+    def __init__(self, wakeup=None):
+        self.wakeup = wakeup
+        self.flag = False
+        self.changed = Condition(Lock())
+
+    def is_set(self):
+        return self.flag
+
+    def set(self):
+        self._flip(True)
+
+    def clear(self):
+        self._flip(False)
+
+    def _flip(self, flag):
+        with self.changed:
+            self.flag = flag
+            self.changed.notify_all()
+        if self.wakeup:
+            self.wakeup.set()
+
+    def wait_clear(self, timeout=None):
+        # Returns whether it's clear, which is only False after a timeout
+        deadline = None if timeout is None else time.time() + timeout
+        with self.changed:
+            while self.flag:
+                remaining = None
+                if deadline is not None:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        break
+                self.changed.wait(remaining)
+            return not self.flag
+
+
+class ScheduledQueue(BoundedQueue):
+    '''
+    Queue of search items, (step, location, appears, leaves) tuples, handed
+    out in order of when they are due instead of when they were queued. An
+    item is due delay seconds after it appears; items without an appearance
+    time are due right away and come out in the order they were put in.
+
+    get() blocks until the earliest item is due, so nobody has to take an item
+    early and sleep on it while items due sooner are stuck behind it. Pass a
+    timeout to get() to wake up regularly, e.g. to check for a pause.
+
+    With a speed (in m/s), consumers that pass their position and the time of
+    their last scan to get() are handed the item they can be at soonest
+    without travelling faster than that, instead of the earliest one. Only
+    the WINDOW items due first are considered for that.
+
+    Every get() that leaves low_water items or fewer sets the wakeup event,
+    if there is one, so the producer can top the queue up before it drains.
+    '''
+
+    # Most items looked at to find the one a consumer can be at soonest
+    WINDOW = 64
+
+    def __init__(self, maxsize=0, policy='block', delay=0, speed=0, low_water=0, wakeup=None):
+        self.delay = delay
+        self.speed = speed
+        self.low_water = low_water
+        self.wakeup = wakeup
+        BoundedQueue.__init__(self, maxsize, policy)
+
+    def _init(self, maxsize):
+        # Heap of (due time, sequence number, item)
+        self.queue = []
+        self.sequence = count()
+
+    def _qsize(self, len=len):
+        return len(self.queue)
+
+    def _put(self, item):
+        heappush(self.queue, (self.due(item), next(self.sequence), item))
+
+    def _get(self):
+        return heappop(self.queue)[2]
+
+    def _clear(self):
+        del self.queue[:]
+
+    def due(self, item):
+        appears = item[2]
+        return appears + self.delay if appears else 0
+
+    def peek(self):
+        # The next item to be handed out, or None
+        with self.mutex:
+            return self.queue[0][2] if self.queue else None
+
+    def items(self):
+        # Everything queued, in the order it's due
+        with self.mutex:
+            return [item for due, sequence, item in sorted(self.queue)]
+
+    def travel_time(self, position, item):
+        x, y = local_xy(position, item[1][0], item[1][1])
+        return math.hypot(x, y) / self.speed
+
+    def _next(self, position, last_scan):
+        # (time the consumer can take it, index) of the item it should take next
+        if not self.speed or position is None:
+            return self.queue[0][0], 0
+
+        # Walk the heap in due order. Nothing can be taken before it's due, so
+        # once the next item is due after the best one can be reached, none of
+        # the rest can beat it either.
+        best = None
+        frontier = [(self.queue[0], 0)]
+        for looked in range(self.WINDOW):
+            if not frontier:
+                break
+            (due, sequence, item), index = heappop(frontier)
+            if best is not None and due >= best[0][0]:
+                break
+
+            ready = max(due, last_scan + self.travel_time(position, item))
+            if best is None or (ready, due, sequence) < best[0]:
+                best = (ready, due, sequence), index
+
+            for child in (2 * index + 1, 2 * index + 2):
+                if child < len(self.queue):
+                    heappush(frontier, (self.queue[child], child))
+        return best[0][0], best[1]
+
+    def _take(self, index):
+        if index == 0:
+            return self._get()
+        item = self.queue[index][2]
+        self.queue[index] = self.queue[-1]
+        self.queue.pop()
+        heapify(self.queue)
+        return item
+
+    def get(self, block=True, timeout=None, position=None, last_scan=0):
+        if timeout is not None and timeout < 0:
+            raise ValueError("'timeout' must be a non-negative number")
+        deadline = None if timeout is None else time.time() + timeout
+
+        with self.not_empty:
+            while True:
+                wait = None
+                if self.queue:
+                    ready, index = self._next(position, last_scan)
+                    wait = ready - time.time()
+                    if wait <= 0:
+                        item = self._take(index)
+                        self.not_full.notify()
+                        if self.wakeup and self._qsize() <= self.low_water:
+                            self.wakeup.set()
+                        return item
+
+                if not block:
+                    raise Empty
+                if deadline is not None:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise Empty
+                    wait = remaining if wait is None else min(wait, remaining)
+
+                # Woken early by put() or reschedule() when an item becomes due sooner
+                self.not_empty.wait(wait)
+
+    def task_done(self, item=None):
+        # Workers say which item they're done with, for queues that track
+        # the items they hand out (CoordinatorQueue); this one doesn't need to
+        BoundedQueue.task_done(self)
+
+    def ready_in(self, position=None, last_scan=0):
+        # Seconds until get() would hand this consumer an item, None if there are none
+        with self.mutex:
+            if not self.queue:
+                return None
+            return max(0, self._next(position, last_scan)[0] - time.time())
+
+    def reschedule(self, update):
+        # Calls update(item) for every queued item; it returns the item to keep,
+        # with new times if its deadline changed, or None to drop it. If any
+        # did, the queue is reordered to match and waiting consumers are woken
+        # up. Returns how many items were dropped.
+        with self.mutex:
+            entries = []
+            changed = False
+            for due, sequence, entry in self.queue:
+                item = update(entry)
+                if item is not None:
+                    entries.append((self.due(item), sequence, item))
+                changed = changed or item is not entry
+            if not changed:
+                return 0
+            removed = len(self.queue) - len(entries)
+
+            heapify(entries)
+            self.queue = entries
+            self._forget(removed)
+            self.not_empty.notify_all()
+            return removed
+
+
+def spill_path(spill_dir, shard):
+    return os.path.join(spill_dir, 'db-queue-{}.spill'.format(shard))
+
+
+class SpillQueue(BoundedQueue):
+    '''
+    FIFO queue that appends every item to an append-only spill file as it is
+    put. At most memory_size items are also kept in memory; the rest are read
+    back from the file once the in-memory head has drained.
+
+    Records stay on disk until the consumer calls task_done() for them, and
+    the last acknowledged offset is kept next to the spill file. A restarted
+    process replays everything after that offset, so nothing that was queued
+    is lost when the process dies. The offset is saved in batches (see
+    COMMIT_RECORDS and COMMIT_INTERVAL), so a crash can replay up to a batch
+    of items that were already written; db updates are upserts, so that's
+    harmless. Meant for a single consumer, like a db_updater thread draining
+    its shard.
+    '''
+
+    def __init__(self, path, memory_size, maxsize=0, policy='block'):
+        self.path = path
+        self.memory_size = memory_size
+        BoundedQueue.__init__(self, maxsize, policy)
+        # Replayed records still need their task_done()
+        self.unfinished_tasks = self.spilled
+
+    def _init(self, maxsize):
+        # In-memory items are (end offset in the spill file, item)
+        self.queue = deque()
+        self.spilled = 0
+        self.inflight = None
+        # Acknowledged but not yet saved
+        self.acked = None
+        self.uncommitted = 0
+        self.committed_at = time.time()
+
+        self.committed = self._read_commit()
+        self.writer = open(self.path, 'ab')
+        self.reader = open(self.path, 'rb')
+        self.read_offset = self.committed
+        self.write_offset = self._recover()
+
+        if self.spilled:
+            log.info('Replaying %d unflushed records (%d bytes) from %s',
+                     self.spilled, self.write_offset - self.committed, self.path)
+
+    def _qsize(self, len=len):
+        return len(self.queue) + self.spilled
+
+    def _put(self, item):
+        data = pickle.dumps(item, pickle.HIGHEST_PROTOCOL)
+        self.writer.write(RECORD_HEADER.pack(len(data)) + data)
+        self.writer.flush()
+        self.write_offset += RECORD_HEADER.size + len(data)
+
+        # Once anything has to be read back, newer items have to wait their turn on disk too
+        if self.spilled or len(self.queue) >= self.memory_size:
+            self.spilled += 1
+        else:
+            self.queue.append((self.write_offset, item))
+            # Nothing left to read back before this one
+            self.read_offset = self.write_offset
+
+    def _get(self):
+        if not self.queue:
+            self._load(max(1, self.memory_size))
+
+        offset, item = self.queue.popleft()
+        self.inflight = offset
+        return item
+
+    def task_done(self):
+        with self.mutex:
+            if self.inflight is not None:
+                self.acked = self.inflight
+                self.inflight = None
+                self.uncommitted += 1
+                if (self.uncommitted >= COMMIT_RECORDS or time.time() - self.committed_at >= COMMIT_INTERVAL or
+                        (self.acked >= self.write_offset and self.write_offset >= TRUNCATE_SIZE)):
+                    self._commit(self.acked)
+        BoundedQueue.task_done(self)
+
+    def spilled_bytes(self):
+        return self.write_offset - self.committed
+
+    def close(self):
+        with self.mutex:
+            if self.acked is not None:
+                self._commit(self.acked)
+        self.writer.close()
+        self.reader.close()
+
+    def remove(self):
+        for path in (self.path, self.path + '.offset'):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def _load(self, count):
+        self.reader.seek(self.read_offset)
+        while self.spilled and count:
+            size = RECORD_HEADER.unpack(self.reader.read(RECORD_HEADER.size))[0]
+            item = pickle.loads(self.reader.read(size))
+            self.read_offset += RECORD_HEADER.size + size
+            self.queue.append((self.read_offset, item))
+            self.spilled -= 1
+            count -= 1
+
+    def _commit(self, offset):
+        self.acked = None
+        self.uncommitted = 0
+        self.committed_at = time.time()
+        if offset >= self.write_offset:
+            # Everything queued is in the database, start with an empty file again
+            self.writer.truncate(0)
+            self.writer.seek(0)
+            offset = self.read_offset = self.write_offset = 0
+        self.committed = offset
+        with open(self.path + '.offset', 'w') as f:
+            f.write(str(offset))
+
+    def _read_commit(self):
+        try:
+            with open(self.path + '.offset') as f:
+                return int(f.read().strip() or 0)
+        except IOError:
+            return 0
+
+    def _recover(self):
+        # Count the complete records after the committed offset, and cut off a
+        # partial record left behind by a crash in the middle of a write
+        size = os.path.getsize(self.path)
+        offset = min(self.committed, size)
+        self.committed = self.read_offset = offset
+        self.reader.seek(offset)
+        while offset + RECORD_HEADER.size <= size:
+            length = RECORD_HEADER.unpack(self.reader.read(RECORD_HEADER.size))[0]
+            if offset + RECORD_HEADER.size + length > size:
+                break
+            self.reader.seek(length, os.SEEK_CUR)
+            offset += RECORD_HEADER.size + length
+            self.spilled += 1
+
+        if offset < size:
+            log.warning('Discarding %d bytes of incomplete data at the end of %s', size - offset, self.path)
+            self.writer.truncate(offset)
+        return offset
@@ -15,6 +15,14 @@ Search Architecture:
    - Listens to the same Queue for areas to scan
    - Can re-login as needed
    - Pushes finds to db queue and webhook queue
+ - With --search-engine coroutines the workers are generators instead,
+   multiplexed on a few shared engine threads that resume each one when
+   the sleep it yielded is over
+ - With --scan-processes the workers are split over that many scanner
+   processes, which use the overseer's queues, accounts and status over IPC
+ - With --coordinator the overseer also lends its search items out to remote
+   nodes over HTTP; nodes started with --coordinator-url lease their search
+   items from it instead of running a schedule of their own
 '''
 
 import logging
@@ -22,29 +30,42 @@ import math
 import json
 import os
 import random
+import socket
 import time
+import cPickle as pickle
 import geopy
 import geopy.distance
+import requests
 
+from collections import deque, OrderedDict
 from datetime import datetime
+from heapq import heapify, heappop, heappush
 from operator import itemgetter
-from threading import Thread
-from queue import Queue, Empty
+from multiprocessing import Process, cpu_count
+from threading import Thread, Lock
+from queue import Empty
 
-from pgoapi import PGoApi
 from pgoapi.utilities import f2i
 from pgoapi import utilities as util
-from pgoapi.exceptions import AuthException
-
-from .models import parse_map, Pokemon, hex_bounds, GymDetails, parse_gyms, MainWorker, WorkerStatus
-from .transform import generate_location_steps
-from .fakePogoApi import FakePogoApi
+from pgoapi.exceptions import AuthException, ServerBusyOrOfflineException
+
+from .models import parse_map, Pokemon, hex_bounds, parse_gyms, gym_cache, MainWorker, WorkerStatus
+from .transform import generate_location_steps, local_xy, local_latlng, SpatialGrid
+from .queues import ScheduledQueue
+from .engine import CoroutineEngine
+from .ipc import serve, connect, start_process
+from .coordinator import CoordinatorQueue
+from .accounts import new_api, AccountPool, LoginManager
+from .proxy import ProxyPool
 from .utils import now
 
 import terminalsize
 
 log = logging.getLogger(__name__)
 
+# Bumped whenever what's in a checkpoint changes
+CHECKPOINT_VERSION = 2
+
 TIMESTAMP = '\000\000\000\000\000\000\000\000\000\000\000\000\000\000\000\000\000\000\000\000\000'
 
 
@@ -86,16 +107,19 @@ def switch_status_printer(display_type, current_page):
                 mainlog.handlers[0].setLevel(logging.CRITICAL)
                 display_type[0] = 'workers'
         elif command.isdigit():
-                current_page[0] = int(command)
-                mainlog.handlers[0].setLevel(logging.CRITICAL)
-                display_type[0] = 'workers'
+            current_page[0] = int(command)
+            mainlog.handlers[0].setLevel(logging.CRITICAL)
+            display_type[0] = 'workers'
         elif command.lower() == 'f':
-                mainlog.handlers[0].setLevel(logging.CRITICAL)
-                display_type[0] = 'failedaccounts'
+            mainlog.handlers[0].setLevel(logging.CRITICAL)
+            display_type[0] = 'failedaccounts'
+        elif command.lower() == 'p':
+            mainlog.handlers[0].setLevel(logging.CRITICAL)
+            display_type[0] = 'proxies'
 
 
 # Thread to print out the status of each worker
-def status_printer(threadStatus, search_items_queue, db_updates_queue, wh_queue, account_queue, account_failures):
+def status_printer(threadStatus, search_items_queue, db_updates_queue, wh_queue, account_pool, proxy_pool):
     display_type = ["workers"]
     current_page = [1]
 
@@ -132,8 +156,33 @@ def status_printer(threadStatus, search_items_queue, db_updates_queue, wh_queue,
                 if 'skip' in threadStatus[item]:
                     skip_total += threadStatus[item]['skip']
 
+            # Show the depth of each db shard when there is more than one db thread
+            db_shards = db_updates_queue.shard_sizes()
+            db_status = str(sum(db_shards))
+            if len(db_shards) > 1:
+                db_status += ' (' + '/'.join(str(size) for size in db_shards) + ')'
+            db_spilled = db_updates_queue.spilled_bytes()
+            if db_spilled:
+                db_status += ' ({:.1f} MB on disk)'.format(db_spilled / 1048576.0)
+
             # Print the queue length
-            status_text.append('Queues: {} search items, {} db updates, {} webhook.  Total skipped items: {}. Spare accounts available: {}. Accounts on hold: {}'.format(search_items_queue.qsize(), db_updates_queue.qsize(), wh_queue.qsize(), skip_total, account_queue.qsize(), len(account_failures)))
+            status_text.append('Queues: {} search items, {} db updates, {} webhook.  Total skipped items: {}. Spare accounts available: {}. Accounts on hold: {}'.format(search_items_queue.qsize(), db_status, wh_queue.qsize(), skip_total, account_pool.qsize(), account_pool.resting_count()))
+
+            # Updates thrown away by the 'drop' backpressure policy
+            dropped = db_updates_queue.dropped() + wh_queue.dropped
+            if dropped:
+                status_text[-1] += ' Dropped low priority updates: {}.'.format(dropped)
+
+            # Proxies routed around for failing too often
+            if proxy_pool:
+                proxies = proxy_pool.status()
+                status_text[-1] += ' Proxies evicted: {} of {}.'.format(sum(1 for proxy in proxies if proxy['evicted']), len(proxies))
+
+            # How far accounts move between two scans
+            jumps = sum(s.get('jumps', 0) for s in threadStatus.values())
+            if jumps:
+                jump_distance = sum(s['jump_distance'] for s in threadStatus.values() if 'jump_distance' in s)
+                status_text[-1] += ' Average jump: {:.0f}m.'.format(jump_distance / jumps)
 
             # Print status of overseer
             status_text.append('{} Overseer: {}'.format(threadStatus['Overseer']['method'], threadStatus['Overseer']['message']))
@@ -184,47 +233,44 @@ def status_printer(threadStatus, search_items_queue, db_updates_queue, wh_queue,
             status_text.append('-----------------------------------------')
 
             # Find the longest account name
+            holds = account_pool.holds()
             userlen = 4
-            for account in account_failures:
+            for account in holds:
                 userlen = max(userlen, len(account['account']['username']))
 
-            status = '{:' + str(userlen) + '} | {:10} | {:20}'
-            status_text.append(status.format('User', 'Hold Time', 'Reason'))
+            status = '{:' + str(userlen) + '} | {:10} | {:6} | {:20}'
+            status_text.append(status.format('User', 'Hold Time', 'Health', 'Reason'))
 
-            for account in account_failures:
-                status_text.append(status.format(account['account']['username'], time.strftime('%H:%M:%S', time.localtime(account['last_fail_time'])), account['reason']))
+            for account in holds:
+                status_text.append(status.format(account['account']['username'], time.strftime('%H:%M:%S', time.localtime(account['last_fail_time'])), '{:.2f}'.format(account_pool.score(account['account']['username'])), account['reason']))
+
+        elif display_type[0] == 'proxies':
+            status_text.append('-----------------------------------------')
+            status_text.append('Proxies:')
+            status_text.append('-----------------------------------------')
+
+            proxies = proxy_pool.status() if proxy_pool else []
+
+            # Find the longest proxy
+            proxylen = 5
+            for proxy in proxies:
+                proxylen = max(proxylen, len(proxy['proxy']))
+
+            status = '{:5} | {:' + str(proxylen) + '} | {:7} | {:6} | {:8} | {:8} | {:7}'
+            status_text.append(status.format('Index', 'Proxy', 'Latency', 'Errors', 'Requests', 'Sessions', 'State'))
+
+            for index, proxy in enumerate(proxies):
+                latency = '-' if proxy['latency'] is None else '{:.0f}ms'.format(proxy['latency'] * 1000)
+                status_text.append(status.format(index, proxy['proxy'], latency, '{:.0%}'.format(proxy['errors']), proxy['requests'], proxy['sessions'], 'evicted' if proxy['evicted'] else 'ok'))
 
         # Print the status_text for the current screen
-        status_text.append('Page {}/{}. Page number to switch pages. F to show on hold accounts. <ENTER> alone to switch between status and log view'.format(current_page[0], total_pages))
+        status_text.append('Page {}/{}. Page number to switch pages. F to show on hold accounts. P to show proxies. <ENTER> alone to switch between status and log view'.format(current_page[0], total_pages))
         # Clear the screen
         os.system('cls' if os.name == 'nt' else 'clear')
         # Print status
         print "\n".join(status_text)
 
 
-# The account recycler monitors failed accounts and places them back in the account queue 2 hours after they failed.
-# This allows accounts that were soft banned to be retried after giving them a chance to cool down.
-def account_recycler(accounts_queue, account_failures, args):
-    while True:
-        # Run once a minute
-        time.sleep(60)
-        log.info('Account recycler running. Checking status of {} accounts'.format(len(account_failures)))
-
-        # Create a new copy of the failure list to search through, so we can iterate through it without it changing
-        failed_temp = list(account_failures)
-
-        # Search through the list for any item that last failed before 2 hours ago
-        ok_time = now() - args.account_rest_interval
-        for a in failed_temp:
-            if a['last_fail_time'] <= ok_time:
-                # Remove the account from the real list, and add to the account queue
-                log.info('Account {} returning to active duty.'.format(a['account']['username']))
-                account_failures.remove(a)
-                accounts_queue.put(a['account'])
-            else:
-                log.info('Account {} needs to cool off for {} seconds due to {}'.format(a['account']['username'], a['last_fail_time'] - ok_time, a['reason']))
-
-
 def worker_status_db_thread(threads_status, name, db_updates_queue):
     log.info("Clearing previous statuses for '%s' worker", name)
     WorkerStatus.delete().where(WorkerStatus.worker_name == name).execute()
@@ -252,52 +298,90 @@ def worker_status_db_thread(threads_status, name, db_updates_queue):
                     'message': status['message']
                 }
         if overseer is not None:
-            db_updates_queue.put((MainWorker, {0: overseer}))
-            db_updates_queue.put((WorkerStatus, workers))
+            db_updates_queue.put((MainWorker, {0: overseer}), low_priority=True)
+            db_updates_queue.put((WorkerStatus, workers), low_priority=True)
         time.sleep(3)
 
 
 # The main search loop that keeps an eye on the over all process
-def search_overseer_thread(args, method, new_location_queue, pause_bit, encryption_lib_path, db_updates_queue, wh_queue):
+def search_overseer_thread(args, method, new_location_queue, pause_bit, wakeup, encryption_lib_path, db_updates_queue, wh_queue, work_leases=None):
 
     log.info('Search overseer starting')
 
-    search_items_queue = Queue()
-    account_queue = Queue()
+    # Spawn points are scanned 10 seconds after they appear, as a grace period
+    if args.coordinator_url:
+        search_items_queue = CoordinatorQueue(args.coordinator_url, args.status_name or socket.gethostname(), args.coordinator_key)
+    else:
+        # Wake up to queue more once there's not enough left to keep every worker busy
+        search_items_queue = ScheduledQueue(args.search_queue_max, delay=10, speed=args.max_speed / 3.6,
+                                            low_water=max(args.workers, args.search_queue_max // 2), wakeup=wakeup)
+
+    # Remote nodes get to lease from the same queue as our own workers
+    if work_leases:
+        work_leases.attach(search_items_queue)
+
     threadStatus = {}
 
-    '''
-    Create a queue of accounts for workers to pull from. When a worker has failed too many times,
-    it can get a new account from the queue and reinitialize the API. Workers should return accounts
-    to the queue so they can be tried again later, but must wait a bit before doing do so to
-    prevent accounts from being cycled through too quickly.
-    '''
-    for i, account in enumerate(args.accounts):
-        account_queue.put(account)
+    # What the last run was doing, if it was searching the same area
+    checkpoint = load_checkpoint(args, method) if args.checkpoint_file else None
+
+    # The accounts still resting from the last run
+    resting = {}
+    if checkpoint:
+        resting = dict((failure['username'], failure) for failure in checkpoint['account_failures'])
 
-    # Create a list for failed accounts
-    account_failures = []
+    # What each hex step has been finding, to scan the productive ones more often
+    step_yields = StepYields(args.hex_min_revisit) if method == 'hex' and args.adaptive_hex else None
+    if step_yields and checkpoint and checkpoint['step_yields']:
+        step_yields.restore(checkpoint['step_yields'])
 
     threadStatus['Overseer'] = {
         'message': 'Initializing',
         'type': 'Overseer',
-        'method': 'Hex Grid' if method == 'hex' else 'Spawn Point'
+        'method': 'Hex Grid' if method == 'hex' else 'Spawn Point',
+        # Items dropped from the queue for being too late to scan
+        'skip': 0,
     }
 
+    # Proxies are handed out per account session, to whichever is doing best
+    proxy_pool = None
+    if args.proxy:
+        proxy_pool = ProxyPool(args.proxy, args.proxy_timeout, args.proxy_probe_interval, args.proxy_max_errors)
+        proxy_pool.start()
+
+    # Log accounts in ahead of time. Scanner processes have their own login
+    # manager for the accounts they use; spares can only be logged in early
+    # when the workers taking them run in this process.
+    login_manager = None
+    if args.login_threads and args.scan_processes <= 1:
+        login_manager = LoginManager(args, encryption_lib_path, args.login_threads, proxy_pool)
+        login_manager.start()
+
+        # The accounts left in the pool once every worker has taken one
+        for account in [a for a in args.accounts if a['username'] not in resting][args.workers:]:
+            login_manager.prepare(account)
+
+    '''
+    Create a pool of accounts for workers to pull from. When a worker has failed too many times,
+    it gets a new account from the pool and reinitializes the API. The account it gives up rests
+    in the pool for a while before it's handed out again, to prevent accounts from being cycled
+    through too quickly.
+    '''
+    account_pool = AccountPool(args.account_rest_interval, login_manager)
+    for account in args.accounts:
+        if account['username'] in resting:
+            account_pool.rest(account, resting[account['username']]['reason'], resting[account['username']]['last_fail_time'])
+        else:
+            account_pool.put(account)
+
     if(args.print_status):
         log.info('Starting status printer thread')
         t = Thread(target=status_printer,
                    name='status_printer',
-                   args=(threadStatus, search_items_queue, db_updates_queue, wh_queue, account_queue, account_failures))
+                   args=(threadStatus, search_items_queue, db_updates_queue, wh_queue, account_pool, proxy_pool))
         t.daemon = True
         t.start()
 
-    # Create account recycler thread
-    log.info('Starting account recycler thread')
-    t = Thread(target=account_recycler, name='account-recycler', args=(account_queue, account_failures, args))
-    t.daemon = True
-    t.start()
-
     if args.status_name is not None:
         log.info('Starting status database thread')
         t = Thread(target=worker_status_db_thread,
@@ -306,20 +390,8 @@ def search_overseer_thread(args, method, new_location_queue, pause_bit, encrypti
         t.daemon = True
         t.start()
 
-    # Create specified number of search_worker_thread
-    log.info('Starting search worker threads')
+    # Create the status of each search worker; they get a proxy with each account
     for i in range(0, args.workers):
-        log.debug('Starting search worker thread %d', i)
-
-        # Set proxy for each worker, using round robin
-        proxy_display = 'No'
-        proxy_url = False
-
-        if args.proxy:
-            proxy_display = proxy_url = args.proxy[i % len(args.proxy)]
-            if args.proxy_display.upper() != 'FULL':
-                proxy_display = i % len(args.proxy)
-
         workerId = 'Worker {:03}'.format(i)
         threadStatus[workerId] = {
             'type': 'Worker',
@@ -329,17 +401,22 @@ def search_overseer_thread(args, method, new_location_queue, pause_bit, encrypti
             'noitems': 0,
             'skip': 0,
             'user': '',
-            'proxy_display': proxy_display,
-            'proxy_url': proxy_url,
+            'proxy_display': 'No',
+            'proxy_url': False,
+            'position': None,
+            'last_scan': 0,
+            'jumps': 0,
+            'jump_distance': 0,
+            # Accounts were only just active when resuming, no need to spread out their logins
+            'stagger': checkpoint is None or checkpoint['stale'],
         }
 
-        t = Thread(target=search_worker_thread,
-                   name='search-worker-{}'.format(i),
-                   args=(args, account_queue, account_failures, search_items_queue, pause_bit,
-                         encryption_lib_path, threadStatus[workerId],
-                         db_updates_queue, wh_queue))
-        t.daemon = True
-        t.start()
+    worker_args = (args, account_pool, search_items_queue, pause_bit,
+                   encryption_lib_path, db_updates_queue, wh_queue, step_yields, login_manager, proxy_pool)
+    if args.scan_processes > 1:
+        start_scanner_processes(threadStatus, *worker_args)
+    else:
+        start_search_workers(range(0, args.workers), threadStatus, *worker_args)
 
     '''
     For hex scanning, we can generate the full list of scan points well
@@ -355,6 +432,9 @@ def search_overseer_thread(args, method, new_location_queue, pause_bit, encrypti
     # A place to track the current location
     current_location = False
 
+    # Steps of the current loop that haven't fit into the (bounded) search queue yet
+    pending_items = deque()
+
     # Used to tell SPS to scan for all CURRENT pokemon instead
     # of, like during a normal loop, just finding the next one
     # which will appear (since you've already scanned existing
@@ -362,20 +442,25 @@ def search_overseer_thread(args, method, new_location_queue, pause_bit, encrypti
     # Needed in a first loop and pausing/changing location.
     sps_scan_current = True
 
+    next_checkpoint = time.time() + args.checkpoint_interval
+
+    # How few items may be left in the search queue before the next loop is
+    # queued behind them. Small loops are only queued once the last one is
+    # done, so they don't pile up.
+    refill_at = 0
+
     # The real work starts here but will halt on pause_bit.set()
     while True:
 
-        # paused; clear queue if needed, otherwise sleep and loop
+        # paused; clear queue if needed, otherwise wait to be resumed
         while pause_bit.is_set():
-            if not search_items_queue.empty():
-                try:
-                    while True:
-                        search_items_queue.get_nowait()
-                except Empty:
-                    pass
+            pending_items.clear()
+            if work_leases:
+                work_leases.clear()
+            search_items_queue.clear()
             threadStatus['Overseer']['message'] = 'Scanning is paused'
             sps_scan_current = True
-            time.sleep(1)
+            pause_bit.wait_clear()
 
         # If a new location has been passed to us, get the most recent one
         if not new_location_queue.empty():
@@ -388,35 +473,85 @@ def search_overseer_thread(args, method, new_location_queue, pause_bit, encrypti
                 pass
 
             # We (may) need to clear the search_items_queue
-            if not search_items_queue.empty():
-                try:
-                    while True:
-                        search_items_queue.get_nowait()
-                except Empty:
-                    pass
+            pending_items.clear()
+            if work_leases:
+                work_leases.clear()
+            search_items_queue.clear()
+
+            # Carry on with the loop the last run was in the middle of, if it was here too
+            if checkpoint and not checkpoint['stale'] and checkpoint['location'][:2] == current_location[:2]:
+                log.info('Resuming %d search items from %s', len(checkpoint['items']), args.checkpoint_file)
+                pending_items.extend(checkpoint['items'])
+                sps_scan_current = checkpoint['sps_scan_current']
+            checkpoint = None
+
+        # Save where we are, so a restart can pick up from here
+        if args.checkpoint_file and current_location and time.time() >= next_checkpoint:
+            save_checkpoint(args.checkpoint_file, {
+                'version': CHECKPOINT_VERSION,
+                'method': method,
+                'location': current_location,
+                'location_arg': args.location,
+                'step_limit': args.step_limit,
+                'items': (work_leases.items() if work_leases else []) + search_items_queue.items() + list(pending_items),
+                'sps_scan_current': sps_scan_current,
+                # Just the usernames, the accounts themselves come from the config
+                'account_failures': [{'username': hold['account']['username'], 'last_fail_time': hold['last_fail_time'], 'reason': hold['reason']}
+                                     for hold in account_pool.holds()],
+                'step_yields': step_yields.state() if step_yields else None,
+            })
+            next_checkpoint = time.time() + args.checkpoint_interval
+
+        # The coordinator runs the schedule, our workers lease from it directly
+        if args.coordinator_url:
+            threadStatus['Overseer']['message'] = 'Getting search items from {}'.format(args.coordinator_url)
+            wakeup.wait(5)
+            wakeup.clear()
+            continue
+
+        # Items out on lease too long go back in the queue
+        if work_leases:
+            work_leases.expire()
+
+        # Spawns that will be gone before anyone can get to them would only be
+        # taken by a worker to be skipped; drop them from the queue instead
+        threadStatus['Overseer']['skip'] += search_items_queue.reschedule(
+            lambda item: None if item[3] and now() > item[3] - args.min_seconds_left else item)
 
-        # If there are no search_items_queue either the loop has finished (or been
-        # cleared above) -- either way, time to fill it back up
-        if search_items_queue.empty():
-            log.debug('Search queue empty, restarting loop')
+        # If the search queue is (nearly) empty either the loop is finishing (or
+        # it was cleared above) -- either way, time to fill it back up
+        if search_items_queue.qsize() <= refill_at and not pending_items:
+            log.debug('Search queue low, queueing the next loop')
 
             # locations = [((lat, lng, alt), ts_appears, ts_leaves),...]
             if method == 'hex':
                 locations = get_hex_location_list(args, current_location)
+                if step_yields:
+                    steps = len(locations)
+                    locations = step_yields.select(locations)
+                    log.info('Adaptive hex: scanning %d of %d steps this loop', len(locations), steps)
             else:
                 locations = get_sps_location_list(args, current_location, sps_scan_current)
                 sps_scan_current = False
 
             if len(locations) == 0:
                 log.warning('Nothing to scan!')
+            refill_at = min(search_items_queue.low_water, len(locations) // 2)
+
+            # Steps still queued (or out on lease) from this loop come up in the
+            # next one too: hex steps always, spawns at the same time. Scan them once.
+            queued = (work_leases.items() if work_leases else []) + search_items_queue.items()
+            queued = set((tuple(item[1]), item[2]) for item in queued)
 
             threadStatus['Overseer']['message'] = 'Queuing steps'
             for step, step_location in enumerate(locations, 1):
+                if (tuple(step_location[0]), step_location[1]) in queued:
+                    continue
                 log.debug('Queueing step %d @ %f/%f/%f', step, step_location[0][0], step_location[0][1], step_location[0][2])
                 search_args = (step, step_location[0], step_location[1], step_location[2])
-                search_items_queue.put(search_args)
-        else:
-            nextitem = search_items_queue.queue[0]
+                pending_items.append(search_args)
+        elif search_items_queue.peek():
+            nextitem = search_items_queue.peek()
             threadStatus['Overseer']['message'] = 'Processing search queue, next item is {:6f},{:6f}'.format(nextitem[1][0], nextitem[1][1])
             # If times are specified, print the time of the next queue item, and how many seconds ahead/behind realtime
             if nextitem[2]:
@@ -425,11 +560,216 @@ def search_overseer_thread(args, method, new_location_queue, pause_bit, encrypti
                     threadStatus['Overseer']['message'] += ' ({}s ahead)'.format(nextitem[2] - now())
                 else:
                     threadStatus['Overseer']['message'] += ' ({}s behind)'.format(now() - nextitem[2])
+            if work_leases:
+                threadStatus['Overseer']['message'] += ', {} out on lease'.format(work_leases.size())
+
+        # Feed the search queue from the current loop, as far as its bound allows
+        while pending_items and not search_items_queue.full():
+            search_items_queue.put(pending_items.popleft())
+
+        # Sleep until the search queue runs low, search control changes or a
+        # new location comes in; look after the rest every few seconds
+        wakeup.wait(5)
+        wakeup.clear()
+
+
+def load_checkpoint(args, method):
+    path = args.checkpoint_file
+    if not os.path.isfile(path):
+        return None
+
+    try:
+        with open(path, 'rb') as f:
+            checkpoint = pickle.load(f)
+    except Exception as e:
+        log.warning('Unable to read checkpoint %s, starting from scratch: %s', path, e)
+        return None
+
+    if (checkpoint.get('version') != CHECKPOINT_VERSION or checkpoint['method'] != method or
+            checkpoint['location_arg'] != args.location or checkpoint['step_limit'] != args.step_limit):
+        log.info('Checkpoint %s is for a different search, starting from scratch', path)
+        return None
+
+    # Too old to pick the schedule back up, but resting accounts and step yields still hold
+    age = now() - checkpoint['time']
+    checkpoint['stale'] = age > args.checkpoint_max_age
+    if checkpoint['stale']:
+        log.info('Checkpoint %s was saved %ds ago, only restoring resting accounts and step yields', path, age)
+    else:
+        log.info('Resuming from checkpoint %s, saved %ds ago', path, age)
+    return checkpoint
+
 
-        # Now we just give a little pause here
+def save_checkpoint(path, checkpoint):
+    # Replace the old checkpoint only once the new one is complete
+    checkpoint['time'] = now()
+    try:
+        with open(path + '.tmp', 'wb') as f:
+            pickle.dump(checkpoint, f, pickle.HIGHEST_PROTOCOL)
+        if os.name == 'nt' and os.path.exists(path):
+            os.remove(path)
+        os.rename(path + '.tmp', path)
+    except (IOError, OSError) as e:
+        log.warning('Unable to save checkpoint %s: %s', path, e)
+
+
+def start_search_workers(workers, threadStatus, args, account_pool, search_items_queue, pause_bit, encryption_lib_path, db_updates_queue, wh_queue, step_yields, login_manager, proxy_pool):
+
+    # Coroutine workers share a few engine threads instead of one thread each
+    engine = None
+    if args.search_engine == 'coroutines':
+        # Every blocking request holds on to an engine thread, so fewer threads than workers caps the scan rate
+        threads = args.engine_threads
+        if not threads:
+            threads = min(len(workers), 4 * cpu_count())
+        elif threads < len(workers):
+            log.warning('Only %d search engine threads for %d workers, at most %d requests will be in flight at once', threads, len(workers), threads)
+        log.info('Starting %d search engine threads', threads)
+        engine = CoroutineEngine(threads, 'search-engine')
+        engine.start()
+
+    # Create specified number of search_worker_thread
+    log.info('Starting search workers')
+    for i in workers:
+        log.debug('Starting search worker thread %d', i)
+
+        worker_args = (args, account_pool, search_items_queue, pause_bit,
+                       encryption_lib_path, threadStatus['Worker {:03}'.format(i)],
+                       db_updates_queue, wh_queue, step_yields, login_manager, proxy_pool)
+
+        if engine:
+            engine.spawn(search_worker(*worker_args, block=False))
+            continue
+
+        t = Thread(target=search_worker_thread,
+                   name='search-worker-{}'.format(i),
+                   args=worker_args)
+        t.daemon = True
+        t.start()
+
+
+def start_scanner_processes(threadStatus, args, account_pool, search_items_queue, pause_bit, encryption_lib_path, db_updates_queue, wh_queue, step_yields, login_manager, proxy_pool):
+
+    # Scanners work off the overseer's queues and accounts, and everything
+    # they find is written to the database (and webhooks) from this process
+    shared = serve({
+        'search_items': search_items_queue,
+        'accounts': account_pool,
+        'pause_bit': pause_bit,
+        'db_updates': db_updates_queue,
+        'wh_updates': wh_queue,
+        'status': threadStatus,
+        'step_yields': step_yields,
+        'proxies': proxy_pool,
+    })
+
+    # Deal the workers out over the processes
+    for index in range(0, min(args.scan_processes, args.workers)):
+        workers = range(index, args.workers, args.scan_processes)
+        statuses = dict((id, threadStatus[id]) for id in ['Worker {:03}'.format(i) for i in workers])
+        log.info('Starting scanner process %d with %d search workers', index, len(workers))
+        p = Process(target=scanner_process, name='scanner-{}'.format(index),
+                    args=(args, workers, statuses, encryption_lib_path) + shared)
+        p.daemon = True
+        start_process(p)
+
+
+def scanner_process(args, workers, threadStatus, encryption_lib_path, address, authkey, names):
+
+    # Run our share of the search workers on the overseer's queues, and let
+    # it know how they're doing every second
+    shared = connect(address, authkey, names)
+
+    login_manager = None
+    if args.login_threads:
+        login_manager = LoginManager(args, encryption_lib_path, args.login_threads, shared['proxies'])
+        login_manager.start()
+
+    start_search_workers(workers, threadStatus, args, shared['accounts'], shared['search_items'], shared['pause_bit'], encryption_lib_path,
+                         shared['db_updates'], shared['wh_updates'], shared['step_yields'], login_manager,
+                         shared['proxies'])
+
+    while True:
+        shared['status'].update(threadStatus)
         time.sleep(1)
 
 
+class StepYields(object):
+    '''
+    Per step statistics for adaptive hex scanning: an exponential moving
+    average of the new encounters each scan of a step finds, and when it was
+    last scanned and last found something new.
+
+    Every loop each step earns credit in proportion to its expected new
+    finds, relative to the best step, and gets scanned once it has a full
+    credit. The best steps are scanned every loop and empty ones only now and
+    then, but never less than once every min_revisit seconds.
+    '''
+
+    # Weight of the latest scan in the moving average
+    ALPHA = 0.3
+    # Expected finds added to every step, so empty steps still earn some credit
+    PRIOR = 0.05
+
+    def __init__(self, min_revisit):
+        self.lock = Lock()
+        self.min_revisit = min_revisit
+        self.steps = {}
+        # Encounter ids seen in the last hour, oldest first
+        self.seen = OrderedDict()
+
+    def record(self, location, encounters):
+        with self.lock:
+            now = time.time()
+            new = 0
+            for encounter_id in encounters:
+                if encounter_id not in self.seen:
+                    self.seen[encounter_id] = now
+                    new += 1
+            # Nothing lives longer than an hour, forget older encounters
+            while self.seen and next(self.seen.itervalues()) < now - 3600:
+                self.seen.popitem(last=False)
+
+            step = self.steps.setdefault(location[:2], {'yield': new, 'credit': 0, 'last_find': 0})
+            step['yield'] = (1 - self.ALPHA) * step['yield'] + self.ALPHA * new
+            step['last_scan'] = now
+            if new:
+                step['last_find'] = now
+
+    def state(self):
+        # What restore() needs to pick up from here, e.g. after a restart
+        with self.lock:
+            return {'steps': dict((k, dict(v)) for k, v in self.steps.items()), 'seen': OrderedDict(self.seen)}
+
+    def restore(self, state):
+        with self.lock:
+            self.steps = state['steps']
+            self.seen = state['seen']
+
+    def select(self, locations):
+        # Takes and returns the get_hex_location_list() locations, keeping their order
+        with self.lock:
+            now = time.time()
+            best = max([s['yield'] for s in self.steps.values()] + [0]) + self.PRIOR
+
+            selected = []
+            for location in locations:
+                step = self.steps.get(location[0][:2])
+                # Steps we know nothing about yet, or haven't scanned for too long
+                if step is None or now - step['last_scan'] >= self.min_revisit:
+                    if step:
+                        step['credit'] = 0
+                    selected.append(location)
+                    continue
+
+                step['credit'] += (step['yield'] + self.PRIOR) / best
+                if step['credit'] >= 1:
+                    step['credit'] -= 1
+                    selected.append(location)
+
+            return selected
+
+
 def get_hex_location_list(args, current_location):
     # if we are only scanning for pokestops/gyms, then increase step radius to visibility range
     if args.no_pokemon:
@@ -448,8 +788,20 @@ def get_hex_location_list(args, current_location):
         if len(spawnpoints) == 0:
             log.warning('No spawnpoints found in the specified area! (Did you forget to run a normal scan in this area first?)')
 
+        # Index the spawnpoints on a local plane, so each step only looks at the
+        # spawnpoints around it. The projection is off by well under a meter,
+        # so geopy only has to settle the ones right at the edge of the circle.
+        grid = SpatialGrid(70)
+        for spawnpoint in spawnpoints:
+            x, y = local_xy(current_location, spawnpoint[0], spawnpoint[1])
+            grid.add(spawnpoint, x, y)
+
         def any_spawnpoints_in_range(coords):
-            return any(geopy.distance.distance(coords, x).meters <= 70 for x in spawnpoints)
+            x, y = local_xy(current_location, coords[0], coords[1])
+            for spawnpoint, distance in grid.near(x, y, 71):
+                if distance <= 69 or geopy.distance.distance(coords, spawnpoint).meters <= 70:
+                    return True
+            return False
 
         locations = [coords for coords in locations if any_spawnpoints_in_range(coords)]
 
@@ -491,6 +843,12 @@ def get_sps_location_list(args, current_location, sps_scan_current):
 
     log.info('Total of %d spawns to track', len(locations))
 
+    if args.cluster_spawnpoints:
+        # Leave a minute on every spawn in a cluster for the scan to happen
+        spawns = len(locations)
+        locations = cluster_spawnpoints(locations, 70, 900 - 60 - args.min_seconds_left)
+        log.info('Clustered %d spawns into %d scans, saving %d scans an hour', spawns, len(locations), spawns - len(locations))
+
     locations.sort(key=itemgetter('time'))
 
     if args.very_verbose:
@@ -529,7 +887,7 @@ def get_sps_location_list(args, current_location, sps_scan_current):
             appears = now() + 3600 - late_by
 
         location['appears'] = appears
-        location['leaves'] = appears + 900
+        location['leaves'] = appears + location.get('duration', 900)
 
     # Put the spawn points in order of next appearance time
     locations.sort(key=itemgetter('appears'))
@@ -543,10 +901,84 @@ def get_sps_location_list(args, current_location, sps_scan_current):
     return retset
 
 
-def search_worker_thread(args, account_queue, account_failures, search_items_queue, pause_bit, encryption_lib_path, status, dbq, whq):
+def cluster_spawnpoints(spawns, radius, window):
+    '''
+    Plan scans that each cover several spawns, by greedy set cover: keep
+    picking the scan that covers the most spawns not covered yet.
+
+    A candidate scan is anchored on a spawn and covers the spawns within
+    radius meters of it that appear less than window seconds after it, so the
+    15 minute windows of the whole group overlap. The scan is placed at the
+    group's centroid if that still covers everyone, and happens when the last
+    of them appears. Returns locations like the input, with 'duration' being
+    how long the scan stays valid.
+    '''
+    if not spawns:
+        return []
+
+    origin = (spawns[0]['lat'], spawns[0]['lng'])
+    points = [local_xy(origin, s['lat'], s['lng']) for s in spawns]
+    grid = SpatialGrid(radius)
+    for i, (x, y) in enumerate(points):
+        grid.add(i, x, y)
+
+    covers = []
+    for i, (x, y) in enumerate(points):
+        covers.append(set(j for j, distance in grid.near(x, y, radius)
+                          if (spawns[j]['time'] - spawns[i]['time']) % 3600 < window))
+
+    # Max heap on how many uncovered spawns a scan covers. The sizes only ever
+    # shrink, so an entry that is still accurate when popped is the best one.
+    heap = [(-len(cover), i) for i, cover in enumerate(covers)]
+    heapify(heap)
+    uncovered = set(range(len(spawns)))
+    scans = []
+
+    while uncovered:
+        size, i = heappop(heap)
+        group = covers[i] & uncovered
+        if len(group) < -size:
+            covers[i] = group
+            if group:
+                heappush(heap, (-len(group), i))
+            continue
+
+        uncovered -= group
+        offsets = [(spawns[j]['time'] - spawns[i]['time']) % 3600 for j in group]
+
+        x = sum(points[j][0] for j in group) / len(group)
+        y = sum(points[j][1] for j in group) / len(group)
+        if any(math.hypot(points[j][0] - x, points[j][1] - y) > radius for j in group):
+            x, y = points[i]
+        lat, lng = local_latlng(origin, x, y)
+
+        scans.append({
+            'lat': lat,
+            'lng': lng,
+            'time': (spawns[i]['time'] + max(offsets)) % 3600,
+            'duration': 900 - (max(offsets) - min(offsets)),
+        })
+
+    return scans
+
+
+def search_worker_thread(args, account_pool, search_items_queue, pause_bit, encryption_lib_path, status, dbq, whq, step_yields=None, login_manager=None, proxy_pool=None):
 
     log.debug('Search worker thread starting')
 
+    # Run the worker in this thread, doing its sleeping for it
+    for delay in search_worker(args, account_pool, search_items_queue, pause_bit, encryption_lib_path, status, dbq, whq, step_yields, login_manager, proxy_pool):
+        time.sleep(delay)
+
+
+def search_worker(args, account_pool, search_items_queue, pause_bit, encryption_lib_path, status, dbq, whq, step_yields=None, login_manager=None, proxy_pool=None, block=True):
+    '''
+    The search worker, as a generator that yields the number of seconds it
+    wants to sleep instead of sleeping. With block=False it never waits on
+    the account or search queues either, and yields until they have
+    something for it, so it can share its thread with other workers.
+    '''
+
     # The outer forever loop restarts only when the inner one is intentionally exited - which should only be done when the worker is failing too often, and probably banned.
     # This reinitializes the API and grabs a new account from the queue.
     while True:
@@ -556,12 +988,31 @@ def search_worker_thread(args, account_queue, account_failures, search_items_que
             # Get account
             status['message'] = 'Waiting to get new account from the queue'
             log.info(status['message'])
-            account = account_queue.get()
+            account = None
+            while account is None:
+                try:
+                    account = account_pool.get(block)
+                except Empty:
+                    yield 1
             status['message'] = 'Switching to account {}'.format(account['username'])
             status['user'] = account['username']
             log.info(status['message'])
 
-            stagger_thread(args, account)
+            # The login manager may have logged the account in already
+            api, login_proxy = login_manager.take(account) if login_manager else (None, None)
+
+            # Every session goes through whichever proxy is doing best right
+            # now, or the one the account logged in through
+            if proxy_pool:
+                assign_proxy(args, status, proxy_pool, login_proxy)
+                if status['proxy_url'] != login_proxy:
+                    # Evicted since, log in again through the new one
+                    api = None
+
+            if status['stagger'] and api is None:
+                for delay in stagger_thread(args, account):
+                    yield delay
+            status['stagger'] = True
 
             # New lease of life right here
             status['fail'] = 0
@@ -569,18 +1020,16 @@ def search_worker_thread(args, account_queue, account_failures, search_items_que
             status['noitems'] = 0
             status['skip'] = 0
 
-            # Create the API instance this will use
-            if args.mock != '':
-                api = FakePogoApi(args.mock)
-            else:
-                api = PGoApi()
+            # A fresh account can start anywhere
+            status['position'] = None
+            status['last_scan'] = 0
 
-            if status['proxy_url']:
-                log.debug("Using proxy %s", status['proxy_url'])
+            # Create the API instance this will use
+            if api is None:
+                api = new_api(args, status['proxy_url'], encryption_lib_path)
+            elif status['proxy_url']:
                 api.set_proxy({'http': status['proxy_url'], 'https': status['proxy_url']})
 
-            api.activate_signature(encryption_lib_path)
-
             # The forever loop for the searches
             while True:
 
@@ -588,7 +1037,9 @@ def search_worker_thread(args, account_queue, account_failures, search_items_que
                 if status['fail'] >= args.max_failures:
                     status['message'] = 'Account {} failed more than {} scans; possibly bad account. Switching accounts...'.format(account['username'], args.max_failures)
                     log.warning(status['message'])
-                    account_failures.append({'account': account, 'last_fail_time': now(), 'reason': 'failures'})
+                    if login_manager:
+                        login_manager.forget(account)
+                    account_pool.rest(account, 'failures')
                     break  # exit this loop to get a new account and have the API recreated
 
                 # If this account has been running too long, let it rest
@@ -596,38 +1047,50 @@ def search_worker_thread(args, account_queue, account_failures, search_items_que
                     if (status['starttime'] <= (now() - args.account_search_interval)):
                         status['message'] = 'Account {} is being rotated out to rest.'.format(account['username'])
                         log.info(status['message'])
-                        account_failures.append({'account': account, 'last_fail_time': now(), 'reason': 'rest interval'})
+                        if login_manager:
+                            login_manager.forget(account)
+                        account_pool.rest(account, 'rest interval')
                         break
 
-                while pause_bit.is_set():
+                if pause_bit.is_set():
                     status['message'] = 'Scanning paused'
-                    time.sleep(2)
-
-                # Grab the next thing to search (when available)
-                status['message'] = 'Waiting for item from queue'
-                step, step_location, appears, leaves = search_items_queue.get()
-
-                # too soon?
-                if appears and now() < appears + 10:  # adding a 10 second grace period
-                    first_loop = True
-                    paused = False
-                    while now() < appears + 10:
-                        if pause_bit.is_set():
-                            paused = True
-                            break  # why can't python just have `break 2`...
-                        remain = appears - now() + 10
-                        status['message'] = 'Early for {:6f},{:6f}; waiting {}s...'.format(step_location[0], step_location[1], remain)
-                        if first_loop:
-                            log.info(status['message'])
-                            first_loop = False
-                        time.sleep(1)
-                    if paused:
-                        search_items_queue.task_done()
+                    # Coroutines can't block on it, they check back every couple of seconds
+                    if block:
+                        pause_bit.wait_clear()
+                    else:
+                        yield 2
+                    continue
+
+                # Don't outrun the db and webhook threads; with the 'slow' backpressure
+                # policy back off here until they catch up, otherwise putting our
+                # results on their queues will block or drop updates
+                if dbq.saturated() or whq.saturated():
+                    status['message'] = 'Downstream queues saturated ({} db updates, {} webhook)'.format(dbq.qsize(), whq.qsize())
+                    log.debug(status['message'])
+                    if args.backpressure == 'slow':
+                        status['message'] += '; slowing down for {}s'.format(args.scan_delay)
+                        yield args.scan_delay
                         continue
 
+                # Grab the next thing to search once it is due. Wake up at least
+                # every second meanwhile, so the checks above still get to run.
+                nextitem = search_items_queue.peek()
+                if nextitem and nextitem[2] and nextitem[2] + 10 > now():
+                    status['message'] = 'Next item {:6f},{:6f} is due in {}s'.format(nextitem[1][0], nextitem[1][1], nextitem[2] + 10 - now())
+                else:
+                    status['message'] = 'Waiting for item from queue'
+                try:
+                    item = search_items_queue.get(block, 1, position=status['position'], last_scan=status['last_scan'])
+                    step, step_location, appears, leaves = item
+                except Empty:
+                    if not block:
+                        wait = search_items_queue.ready_in(status['position'], status['last_scan'])
+                        yield 1 if wait is None else min(wait, 1)
+                    continue
+
                 # too late?
                 if leaves and now() > (leaves - args.min_seconds_left):
-                    search_items_queue.task_done()
+                    search_items_queue.task_done(item)
                     status['skip'] += 1
                     # it is slightly silly to put this in status['message'] since it'll be overwritten very shortly after. Oh well.
                     status['message'] = 'Too late for location {:6f},{:6f}; skipping'.format(step_location[0], step_location[1])
@@ -638,34 +1101,63 @@ def search_worker_thread(args, account_queue, account_failures, search_items_que
                 status['message'] = 'Searching at {:6f},{:6f}'.format(step_location[0], step_location[1])
                 log.info(status['message'])
 
+                # Keep track of how far this account has to jump between scans
+                if status['position']:
+                    status['jumps'] += 1
+                    status['jump_distance'] += calc_distance(status['position'], step_location) * 1000
+                status['position'] = step_location
+
+                # Move off a proxy that was evicted since
+                if proxy_pool and not proxy_pool.usable(status['proxy_url']):
+                    log.info('Proxy %s was evicted, account %s moves to another', status['proxy_url'], account['username'])
+                    assign_proxy(args, status, proxy_pool)
+                    # Don't carry a session over, log in again through the new proxy
+                    api = new_api(args, status['proxy_url'], encryption_lib_path)
+
+                # Switch to the session the login manager renewed ahead of time, if it has
+                if login_manager:
+                    fresh, login_proxy = login_manager.take(account)
+                    # Unless it logged in through a proxy the session has moved off since
+                    if fresh and login_proxy == (status['proxy_url'] or None):
+                        api = fresh
+
                 # Let the api know where we intend to be for this loop
                 api.set_position(*step_location)
 
                 # Ok, let's get started -- check our login status
-                check_login(args, account, api, step_location, status['proxy_url'])
+                for delay in check_login(args, account, api, step_location, status['proxy_url']):
+                    yield delay
+                if login_manager:
+                    login_manager.keep_fresh(account, api, status['proxy_url'])
 
                 # Make the actual request (finally!)
-                response_dict = map_request(api, step_location, args.jitter)
+                response_dict = map_request(api, step_location, args.jitter, proxy_pool, status['proxy_url'])
+                status['last_scan'] = now()
 
                 # G'damnit, nothing back. Mark it up, sleep, carry on
                 if not response_dict:
                     status['fail'] += 1
+                    account_pool.record(account, 'fail')
                     status['message'] = 'Invalid response at {:6f},{:6f}, abandoning location'.format(step_location[0], step_location[1])
                     log.error(status['message'])
-                    time.sleep(args.scan_delay)
+                    yield args.scan_delay
                     continue
 
                 # Got the response, parse it out, send todo's to db/wh queues
                 try:
                     parsed = parse_map(args, response_dict, step_location, dbq, whq)
-                    search_items_queue.task_done()
+                    search_items_queue.task_done(item)
+                    if step_yields:
+                        step_yields.record(step_location, parsed['encounters'])
                     status[('success' if parsed['count'] > 0 else 'noitems')] += 1
+                    account_pool.record(account, 'success' if parsed['count'] > 0 else 'empty')
                     status['message'] = 'Search at {:6f},{:6f} completed with {} finds'.format(step_location[0], step_location[1], parsed['count'])
                     status['fail'] = 0
                     log.debug(status['message'])
                 except KeyError:
                     parsed = False
                     status['fail'] += 1
+                    account_pool.record(account, 'banned')
                     status['message'] = 'Map parse failed at {:6f},{:6f}, abandoning location. {} may be banned.'.format(step_location[0], step_location[1], account['username'])
                     log.exception(status['message'])
 
@@ -678,14 +1170,13 @@ def search_worker_thread(args, account_queue, account_failures, search_items_que
                         distance = calc_distance(step_location, [gym['latitude'], gym['longitude']])
                         if distance < 1:
                             # check if we already have details on this gym (if not, get them)
-                            try:
-                                record = GymDetails.get(gym_id=gym['gym_id'])
-                            except GymDetails.DoesNotExist as e:
+                            last_scanned = gym_cache.get(gym['gym_id'])
+                            if last_scanned is None:
                                 gyms_to_update[gym['gym_id']] = gym
                                 continue
 
                             # if we have a record of this gym already, check if the gym has been updated since our last update
-                            if record.last_scanned < gym['last_modified']:
+                            if last_scanned < gym['last_modified']:
                                 gyms_to_update[gym['gym_id']] = gym
                                 continue
                             else:
@@ -702,7 +1193,7 @@ def search_worker_thread(args, account_queue, account_failures, search_items_que
 
                         for gym in gyms_to_update.values():
                             status['message'] = 'Getting details for gym {} of {} for location {},{}...'.format(current_gym, len(gyms_to_update), step_location[0], step_location[1])
-                            time.sleep(random.random() + 2)
+                            yield random.random() + 2
                             response = gym_request(api, step_location, gym)
 
                             # make sure the gym was in range. (sometimes the API gets cranky about gyms that are ALMOST 1km away)
@@ -718,20 +1209,31 @@ def search_worker_thread(args, account_queue, account_failures, search_items_que
                         log.debug(status['message'])
 
                         if gym_responses:
-                            parse_gyms(args, gym_responses, whq)
+                            parse_gyms(args, gym_responses, whq, dbq)
 
                 # Always delay the desired amount after "scan" completion
                 status['message'] += ', sleeping {}s until {}'.format(args.scan_delay, time.strftime('%H:%M:%S', time.localtime(time.time() + args.scan_delay)))
-                time.sleep(args.scan_delay)
+                yield args.scan_delay
 
         # catch any process exceptions, log them, and continue the thread
         except Exception as e:
             status['message'] = 'Exception in search_worker using account {}. Restarting with fresh account. See logs for details.'.format(account['username'])
-            time.sleep(args.scan_delay)
+            yield args.scan_delay
             log.error('Exception in search_worker under account {} Exception message: {}'.format(account['username'], e))
-            account_failures.append({'account': account, 'last_fail_time': now(), 'reason': 'exception'})
+            if login_manager:
+                login_manager.forget(account)
+            account_pool.rest(account, 'exception')
+
 
+def assign_proxy(args, status, proxy_pool, prefer=None):
+    # Put the worker on a proxy from the pool, in place of the one it's on
+    status['proxy_url'] = proxy_pool.acquire(status['proxy_url'], prefer)
+    status['proxy_display'] = status['proxy_url']
+    if args.proxy_display.upper() != 'FULL':
+        status['proxy_display'] = args.proxy.index(status['proxy_url'])
 
+
+# Like the worker, yields the seconds to sleep for
 def check_login(args, account, api, position, proxy_url):
 
     # Logged in? Enough time left? Cool!
@@ -757,13 +1259,18 @@ def check_login(args, account, api, position, proxy_url):
             else:
                 i += 1
                 log.error('Failed to login to Pokemon Go with account %s. Trying again in %g seconds', account['username'], args.login_delay)
-                time.sleep(args.login_delay)
+                yield args.login_delay
 
     log.debug('Login for account %s successful', account['username'])
-    time.sleep(args.scan_delay)
+    yield args.scan_delay
+
 
+# Requests that never made it to the servers and back; pgoapi wraps
+# connection errors (proxy errors included) as ServerBusyOrOffline
+TRANSPORT_ERRORS = (requests.exceptions.RequestException, ServerBusyOrOfflineException)
 
-def map_request(api, position, jitter=False):
+
+def map_request(api, position, jitter=False, proxy_pool=None, proxy_url=None):
     # create scan_location to send to the api based off of position, because tuples aren't mutable
     if jitter:
         # jitter it, just a little bit.
@@ -773,13 +1280,23 @@ def map_request(api, position, jitter=False):
         # Just use the original coordinates
         scan_location = position
 
+    started = time.time()
     try:
         cell_ids = util.get_cell_ids(scan_location[0], scan_location[1])
         timestamps = [0, ] * len(cell_ids)
-        return api.get_map_objects(latitude=f2i(scan_location[0]),
-                                   longitude=f2i(scan_location[1]),
-                                   since_timestamp_ms=timestamps,
-                                   cell_id=cell_ids)
+        response = api.get_map_objects(latitude=f2i(scan_location[0]),
+                                       longitude=f2i(scan_location[1]),
+                                       since_timestamp_ms=timestamps,
+                                       cell_id=cell_ids)
+        if proxy_pool:
+            proxy_pool.record(proxy_url, time.time() - started, True)
+        return response
+    except TRANSPORT_ERRORS as e:
+        # Only these are the proxy's fault, the rest are down to the account or the servers
+        if proxy_pool:
+            proxy_pool.record(proxy_url, time.time() - started, False)
+        log.warning('Network error while downloading map: %s', e)
+        return False
     except Exception as e:
         log.warning('Exception while downloading map: %s', e)
         return False
@@ -824,7 +1341,7 @@ def stagger_thread(args, account):
         return  # No need to delay the first one
     delay = args.accounts.index(account) + ((random.random() - .5) / 2)
     log.debug('Delaying thread startup for %.2f seconds', delay)
-    time.sleep(delay)
+    yield delay
 
 
 class TooManyLoginAttempts(Exception):
@@ -1,10 +1,19 @@
 import math
 import geopy
+import s2sphere
 
 a = 6378245.0
 ee = 0.00669342162296594323
 pi = 3.14159265358979324
 
+# S2 level of the cell ids stored with every location; level 17 cells are
+# roughly 70m across, about the size of a single scan
+S2_LEVEL = 17
+
+# WGS84 ellipsoid, as used by geopy's distances
+WGS84_A = 6378137.0
+WGS84_E2 = 0.00669437999014
+
 
 def transform_from_wgs_to_gcj(latitude, longitude):
     if is_location_out_of_china(latitude, longitude):
@@ -56,80 +65,181 @@ def get_new_coords(init_loc, distance, bearing):
     return (destination.latitude, destination.longitude)
 
 
+def get_cell_id(latitude, longitude, level=S2_LEVEL):
+    return s2sphere.CellId.from_lat_lng(
+        s2sphere.LatLng.from_degrees(latitude, longitude)).parent(level).id()
+
+
+def get_cell_ranges(south, west, north, east, max_cells=16):
+    """
+    Cover a bounding box with S2 cells and return the (min, max) cell id
+    ranges that a level S2_LEVEL cell id inside the box falls in, with
+    neighbouring ranges merged. Ranges never span two cube faces.
+    """
+    rect = s2sphere.LatLngRect.from_point_pair(
+        s2sphere.LatLng.from_degrees(south, west),
+        s2sphere.LatLng.from_degrees(north, east))
+    coverer = s2sphere.RegionCoverer()
+    coverer.max_level = S2_LEVEL
+    coverer.max_cells = max_cells
+
+    ranges = []
+    for cell in sorted(coverer.get_covering(rect)):
+        low, high = cell.range_min().id(), cell.range_max().id()
+        if ranges and ranges[-1][2] == cell.face() and low <= ranges[-1][1] + 2:
+            ranges[-1][1] = max(high, ranges[-1][1])
+        else:
+            ranges.append([low, high, cell.face()])
+
+    return [(r[0], r[1]) for r in ranges]
+
+
+def local_radii(latitude):
+    """
+    Meters per radian of latitude and of longitude around the given latitude,
+    from the ellipsoid's radii of curvature.
+    """
+    sin_lat = math.sin(math.radians(latitude))
+    w = 1 - WGS84_E2 * sin_lat * sin_lat
+    meridian = WGS84_A * (1 - WGS84_E2) / (w * math.sqrt(w))
+    normal = WGS84_A / math.sqrt(w)
+    return meridian, normal * math.cos(math.radians(latitude))
+
+
+def local_xy(origin, latitude, longitude):
+    """
+    Project a lat/lng to meters east (x) and north (y) of origin. Within the
+    few km of a scan area this is accurate to a fraction of a meter, and much
+    cheaper than a geodesic distance.
+    """
+    lat_radius, lng_radius = local_radii(origin[0])
+    return (math.radians(longitude - origin[1]) * lng_radius,
+            math.radians(latitude - origin[0]) * lat_radius)
+
+
+def local_latlng(origin, x, y):
+    """
+    The inverse of local_xy.
+    """
+    lat_radius, lng_radius = local_radii(origin[0])
+    return (origin[0] + math.degrees(y / lat_radius),
+            origin[1] + math.degrees(x / lng_radius))
+
+
+class SpatialGrid(object):
+    """
+    Points on a local_xy plane bucketed into square cells, to find the points
+    near a location without comparing it against every point.
+    """
+
+    def __init__(self, cell_size):
+        self.cell_size = float(cell_size)
+        self.cells = {}
+
+    def cell(self, x, y):
+        return int(math.floor(x / self.cell_size)), int(math.floor(y / self.cell_size))
+
+    def add(self, key, x, y):
+        self.cells.setdefault(self.cell(x, y), []).append((key, x, y))
+
+    def near(self, x, y, radius):
+        # Yields (key, distance) for every point within radius of x/y
+        reach = int(math.ceil(radius / self.cell_size))
+        cx, cy = self.cell(x, y)
+        for i in range(cx - reach, cx + reach + 1):
+            for j in range(cy - reach, cy + reach + 1):
+                for key, px, py in self.cells.get((i, j), ()):
+                    distance = math.hypot(px - x, py - y)
+                    if distance <= radius:
+                        yield key, distance
+
+
+# Recently generated hex grids, by (location, step count, step distance)
+location_steps_cache = {}
+
+
 def generate_location_steps(initial_loc, step_count, step_distance):
-    # Bearing (degrees)
-    NORTH = 0
-    EAST = 90
-    SOUTH = 180
-    WEST = 270
+    key = (initial_loc[0], initial_loc[1], step_count, step_distance)
+    if key not in location_steps_cache:
+        if len(location_steps_cache) >= 16:
+            location_steps_cache.clear()
+        location_steps_cache[key] = hex_location_steps(initial_loc, step_count, step_distance)
+
+    # Callers get their own copy of the list
+    return list(location_steps_cache[key])
+
 
-    pulse_radius = step_distance         # km - radius of players heartbeat is 70m
+def hex_location_steps(initial_loc, step_count, step_distance):
+    """
+    Walk the hex spiral on axial (column, row) coordinates, where a row is
+    shifted half a column east of the row below it, then place every step
+    relative to the initial location in one go. Unlike chaining geodesic
+    moves from step to step, errors don't add up along the walk.
+    """
+    pulse_radius = step_distance * 1000  # m - radius of players heartbeat is 70m
     xdist = math.sqrt(3) * pulse_radius  # dist between column centers
     ydist = 3 * (pulse_radius / 2)       # dist between row centers
 
-    results = []
+    # (column, row) moves
+    WEST = (-1, 0)
+    EAST = (1, 0)
+    NORTH_EAST = (0, 1)
+    NORTH_WEST = (-1, 1)
+    SOUTH_EAST = (1, -1)
+    SOUTH_WEST = (0, -1)
 
-    results.append((initial_loc[0], initial_loc[1], 0))
+    steps = [(0, 0)]
 
-    if step_count > 1:
-        loc = initial_loc
+    def move(direction):
+        steps.append((steps[-1][0] + direction[0], steps[-1][1] + direction[1]))
 
+    if step_count > 1:
         # upper part
         ring = 1
         while ring < step_count:
 
-            loc = get_new_coords(loc, xdist, WEST if ring % 2 == 1 else EAST)
-            results.append((loc[0], loc[1], 0))
+            move(WEST if ring % 2 == 1 else EAST)
 
             for i in range(ring):
-                loc = get_new_coords(loc, ydist, NORTH)
-                loc = get_new_coords(loc, xdist / 2, EAST if ring % 2 == 1 else WEST)
-                results.append((loc[0], loc[1], 0))
+                move(NORTH_EAST if ring % 2 == 1 else NORTH_WEST)
 
             for i in range(ring):
-                loc = get_new_coords(loc, xdist, EAST if ring % 2 == 1 else WEST)
-                results.append((loc[0], loc[1], 0))
+                move(EAST if ring % 2 == 1 else WEST)
 
             for i in range(ring):
-                loc = get_new_coords(loc, ydist, SOUTH)
-                loc = get_new_coords(loc, xdist / 2, EAST if ring % 2 == 1 else WEST)
-                results.append((loc[0], loc[1], 0))
+                move(SOUTH_EAST if ring % 2 == 1 else SOUTH_WEST)
 
             ring += 1
 
         # lower part
         ring = step_count - 1
 
-        loc = get_new_coords(loc, ydist, SOUTH)
-        loc = get_new_coords(loc, xdist / 2, WEST if ring % 2 == 1 else EAST)
-        results.append((loc[0], loc[1], 0))
+        move(SOUTH_WEST if ring % 2 == 1 else SOUTH_EAST)
 
         while ring > 0:
 
             if ring == 1:
-                loc = get_new_coords(loc, xdist, WEST)
-                results.append((loc[0], loc[1], 0))
+                move(WEST)
 
             else:
                 for i in range(ring - 1):
-                    loc = get_new_coords(loc, ydist, SOUTH)
-                    loc = get_new_coords(loc, xdist / 2, WEST if ring % 2 == 1 else EAST)
-                    results.append((loc[0], loc[1], 0))
+                    move(SOUTH_WEST if ring % 2 == 1 else SOUTH_EAST)
 
                 for i in range(ring):
-                    loc = get_new_coords(loc, xdist, WEST if ring % 2 == 1 else EAST)
-                    results.append((loc[0], loc[1], 0))
+                    move(WEST if ring % 2 == 1 else EAST)
 
                 for i in range(ring - 1):
-                    loc = get_new_coords(loc, ydist, NORTH)
-                    loc = get_new_coords(loc, xdist / 2, WEST if ring % 2 == 1 else EAST)
-                    results.append((loc[0], loc[1], 0))
+                    move(NORTH_WEST if ring % 2 == 1 else NORTH_EAST)
 
-                loc = get_new_coords(loc, xdist, EAST if ring % 2 == 1 else WEST)
-                results.append((loc[0], loc[1], 0))
+                move(EAST if ring % 2 == 1 else WEST)
 
             ring -= 1
 
+    results = []
+    for column, row in steps:
+        lat, lng = local_latlng(initial_loc, xdist * (column + row / 2.0), ydist * row)
+        results.append((lat, lng, 0))
+
     # This will pull the last few steps back to the front of the list
     # so you get a "center nugget" at the beginning of the scan, instead
     # of the entire nothern area before the scan spots 70m to the south.
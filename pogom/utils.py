@@ -12,6 +12,7 @@ import pprint
 import time
 
 from . import config
+from .queues import BACKPRESSURE_POLICIES
 
 log = logging.getLogger(__name__)
 
@@ -54,6 +55,12 @@ def get_args():
                         help='Passwords, either single one for all accounts or one per account.')
     parser.add_argument('-w', '--workers', type=int,
                         help='Number of search worker threads to start. Defaults to the number of accounts specified.')
+    parser.add_argument('-se', '--search-engine', choices=['threads', 'coroutines'], default='threads',
+                        help='Run each search worker in its own thread, or as a coroutine on a small pool of engine threads (default threads)')
+    parser.add_argument('-et', '--engine-threads', type=int,
+                        help='With --search-engine coroutines, number of threads the workers share; also the most logins and api requests in flight at once (default: the number of workers, at most 4 per CPU core)')
+    parser.add_argument('-sp', '--scan-processes', type=int, default=1,
+                        help='Split the search workers over this many processes, to parse scans on more than one CPU core (default 1)')
     parser.add_argument('-asi', '--account-search-interval', type=int, default=0,
                         help='Seconds for accounts to search before switching to a new account. 0 to disable.')
     parser.add_argument('-ari', '--account-rest-interval', type=int, default=7200,
@@ -69,6 +76,8 @@ def get_args():
     parser.add_argument('-sd', '--scan-delay',
                         help='Time delay between requests in scan threads',
                         type=float, default=10)
+    parser.add_argument('--login-threads', type=int, default=2,
+                        help='Threads that log accounts in ahead of time, refreshing logins before they expire and logging spare accounts in while they wait (default 2, 0 to disable)')
     parser.add_argument('-ld', '--login-delay',
                         help='Time delay between each login attempt',
                         type=float, default=5)
@@ -104,6 +113,15 @@ def get_args():
     parser.add_argument('-os', '--only-server',
                         help='Server-Only Mode. Starts only the Webserver without the searcher.',
                         action='store_true', default=False)
+    parser.add_argument('-co', '--coordinator',
+                        help='Lend search items out to remote nodes started with --coordinator-url. Combine with -os to only coordinate, without scanning here.',
+                        action='store_true', default=False)
+    parser.add_argument('-cu', '--coordinator-url',
+                        help='Lease search items from the coordinator at this URL (e.g. http://10.0.0.1:5000) instead of running our own schedule')
+    parser.add_argument('-ck', '--coordinator-key',
+                        help='Key nodes must send to lease search items from the coordinator, required with --coordinator')
+    parser.add_argument('--lease-timeout', type=int, default=120,
+                        help='Seconds a node has to scan a leased search item before the coordinator hands it out again (default 120)')
     parser.add_argument('-nsc', '--no-search-control',
                         help='Disables search control',
                         action='store_false', dest='search_control', default=True)
@@ -135,31 +153,63 @@ def get_args():
                         help='Use spawnpoint scanning (instead of hex grid). Scans in a circle based on step_limit when on DB', nargs='?', const='nofile', default=False)
     parser.add_argument('--dump-spawnpoints', help='dump the spawnpoints from the db to json (only for use with -ss)',
                         action='store_true', default=False)
+    parser.add_argument('-ah', '--adaptive-hex', help='Scan the hex steps that find new pokemon more often than the ones that find nothing',
+                        action='store_true', default=False)
+    parser.add_argument('--hex-min-revisit', help='With --adaptive-hex, scan every step at least once this many seconds',
+                        type=int, default=900)
+    parser.add_argument('-ms', '--max-speed', help='Maximum speed in km/h an account may travel between scans; workers take the queued item they can reach first (0 to disable)',
+                        type=float, default=0)
+    parser.add_argument('-ssc', '--cluster-spawnpoints', help='With -ss, cover spawnpoints that are close together and overlap in time with a single scan',
+                        action='store_true', default=False)
     parser.add_argument('-pd', '--purge-data',
                         help='Clear pokemon from database this many hours after they disappear \
                         (0 to disable)', type=int, default=0)
     parser.add_argument('-px', '--proxy', help='Proxy url (e.g. socks5://127.0.0.1:9050)', action='append')
     parser.add_argument('-pxt', '--proxy-timeout', help='Timeout settings for proxy checker in seconds ', type=int, default=5)
+    parser.add_argument('-pxp', '--proxy-probe-interval', help='Seconds between probes of proxies evicted for failing too often (default 60)', type=int, default=60)
+    parser.add_argument('-pxe', '--proxy-max-errors', help='Share of failed requests (0-1) at which a proxy is evicted (default 0.5)', type=float, default=0.5)
     parser.add_argument('-pxd', '--proxy-display', help='Display info on which proxy beeing used (index or full) To be used with -ps', type=str, default='index')
-    parser.add_argument('--db-type', help='Type of database to be used (default: sqlite)',
-                        default='sqlite')
+    parser.add_argument('--db-type', help='Type of database to be used: sqlite, mysql or postgres (default: sqlite)',
+                        choices=['sqlite', 'mysql', 'postgres'], default='sqlite')
     parser.add_argument('--db-name', help='Name of the database to be used')
     parser.add_argument('--db-user', help='Username for the database')
     parser.add_argument('--db-pass', help='Password for the database')
     parser.add_argument('--db-host', help='IP or hostname for the database')
-    parser.add_argument('--db-port', help='Port for the database', type=int, default=3306)
+    parser.add_argument('--db-port', help='Port for the database (default: 3306 for mysql, 5432 for postgres)', type=int)
     parser.add_argument('--db-max_connections', help='Max connections (per thread) for the database',
                         type=int, default=5)
-    parser.add_argument('--db-threads', help='Number of db threads; increase if the db queue falls behind',
+    parser.add_argument('--db-threads', help='Number of db threads, each writing its own shard of the db queue; increase if the db queue falls behind',
                         type=int, default=1)
+    parser.add_argument('--compact-ids', help='Store encounter, spawnpoint and fort ids as 64 bit integers instead of strings, for much smaller indexes. Converts an existing database on startup; this cannot be undone.',
+                        action='store_true', default=False)
+    parser.add_argument('--db-spill-dir', help='Directory to write the db queue through to, so queued updates survive a crash or restart (default: keep everything in memory)',
+                        default=None)
+    parser.add_argument('--db-queue-memory', help='With --db-spill-dir, number of db queue entries to also keep in memory per db thread; the rest are read back from disk (default 500)',
+                        type=int, default=500)
+    parser.add_argument('--db-queue-max', help='Maximum number of db queue entries per db thread (default 0: unbounded)',
+                        type=int, default=0)
     parser.add_argument('-wh', '--webhook', help='Define URL(s) to POST webhook information to',
                         nargs='*', default=False, dest='webhooks')
     parser.add_argument('-gi', '--gym-info', help='Get all details about gyms (causes an additional API hit for every gym)',
                         action='store_true', default=False)
+    parser.add_argument('--gym-cache-size', help='Number of gyms to remember the last details scan of, gyms beyond this are rescanned (default 10000)',
+                        type=int, default=10000)
     parser.add_argument('--webhook-updates-only', help='Only send updates (pokémon & lured pokéstops)',
                         action='store_true', default=False)
     parser.add_argument('--wh-threads', help='Number of webhook threads; increase if the webhook queue falls behind',
                         type=int, default=1)
+    parser.add_argument('--wh-queue-max', help='Maximum number of webhook queue entries (default 0: unbounded)',
+                        type=int, default=0)
+    parser.add_argument('--checkpoint-file',
+                        help='Save the search schedule and resting accounts to this file, and resume from it after a restart with the same location and step limit')
+    parser.add_argument('--checkpoint-interval', type=int, default=60,
+                        help='Seconds between checkpoints (default 60)')
+    parser.add_argument('--checkpoint-max-age', type=int, default=600,
+                        help='Only resume the search schedule from a checkpoint saved at most this many seconds ago (default 600)')
+    parser.add_argument('--search-queue-max', help='Maximum number of steps the overseer queues up at once (default 0: the whole loop)',
+                        type=int, default=0)
+    parser.add_argument('-bp', '--backpressure', help='What to do when a bounded db or webhook queue is full: block the search workers, drop low priority updates, or slow down the scan rate (default block)',
+                        choices=BACKPRESSURE_POLICIES, default='block')
     parser.add_argument('--ssl-certificate', help='Path to SSL certificate file')
     parser.add_argument('--ssl-privatekey', help='Path to SSL private key file')
     parser.add_argument('-ps', '--print-status', action='store_true',
@@ -177,11 +227,22 @@ def get_args():
 
     args = parser.parse_args()
 
+    # Anyone able to reach the web server could lease our search items otherwise
+    if args.coordinator and not args.coordinator_key:
+        parser.print_usage()
+        print(sys.argv[0] + ": error: argument -ck/--coordinator-key is required with -co/--coordinator")
+        sys.exit(1)
+
     if args.only_server:
         if args.location is None:
             parser.print_usage()
             print(sys.argv[0] + ": error: arguments -l/--location is required")
             sys.exit(1)
+
+        # A coordinator without accounts only runs the schedule for its nodes
+        if args.coordinator:
+            args.accounts = []
+            args.workers = 0
     else:
         # If using a CSV file, add the data into the username,password and auth_service arguments.
         # CSV file should have lines like "ptc,username,password".  Additional fields after that are ignored.
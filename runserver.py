@@ -14,7 +14,6 @@ import json
 from distutils.version import StrictVersion
 
 from threading import Thread, Event
-from queue import Queue
 from flask_cors import CORS
 from flask_cache_bust import init_cache_busting
 
@@ -23,8 +22,10 @@ from pogom.app import Pogom
 from pogom.utils import get_args, get_encryption_lib_path
 
 from pogom.search import search_overseer_thread
-from pogom.models import init_database, create_tables, drop_tables, Pokemon, db_updater, clean_db_loop
+from pogom.models import init_database, create_tables, drop_tables, Pokemon, db_updater, clean_db_loop, gym_cache
 from pogom.webhook import wh_updater
+from pogom.queues import DbUpdateQueue, BoundedQueue, NotifyingQueue, Switch
+from pogom.coordinator import WorkLeases
 
 from pogom.proxy import check_proxies
 
@@ -155,29 +156,34 @@ def main():
     db = init_database(app)
     if args.clear_db:
         log.info('Clearing database')
-        if args.db_type == 'mysql':
+        if args.db_type in ('mysql', 'postgres'):
             drop_tables(db)
         elif os.path.isfile(args.db):
             os.remove(args.db)
     create_tables(db)
 
+    if args.gym_info and not args.only_server:
+        gym_cache.warm()
+
     app.set_current_location(position)
 
+    # Wakes the overseer up when it has something to do
+    overseer_wakeup = Event()
+
     # Control the search status (running or not) across threads
-    pause_bit = Event()
-    pause_bit.clear()
+    pause_bit = Switch(overseer_wakeup)
 
     # Setup the location tracking queue and push the first location on
-    new_location_queue = Queue()
+    new_location_queue = NotifyingQueue(overseer_wakeup)
     new_location_queue.put(position)
 
-    # DB Updates
-    db_updates_queue = Queue()
+    # DB Updates, sharded by model and primary key so each record is only ever written by one thread
+    db_updates_queue = DbUpdateQueue(args.db_threads, args.db_spill_dir, args.db_queue_memory, args.db_queue_max, args.backpressure)
 
-    # Thread(s) to process database updates
-    for i in range(args.db_threads):
+    # Thread(s) to process database updates, one per shard
+    for i, shard in enumerate(db_updates_queue.shards):
         log.debug('Starting db-updater worker thread %d', i)
-        t = Thread(target=db_updater, name='db-updater-{}'.format(i), args=(args, db_updates_queue))
+        t = Thread(target=db_updater, name='db-updater-{}'.format(i), args=(args, shard))
         t.daemon = True
         t.start()
 
@@ -187,7 +193,7 @@ def main():
     t.start()
 
     # WH Updates
-    wh_updates_queue = Queue()
+    wh_updates_queue = BoundedQueue(args.wh_queue_max, args.backpressure)
 
     # Thread to process webhook updates
     for i in range(args.wh_threads):
@@ -196,7 +202,10 @@ def main():
         t.daemon = True
         t.start()
 
-    if not args.only_server:
+    # Search items remote nodes have leased from us
+    work_leases = WorkLeases(args.lease_timeout) if args.coordinator else None
+
+    if not args.only_server or args.coordinator:
 
         # Check all proxies before continue so we know they are good
         if args.proxy:
@@ -220,7 +229,7 @@ def main():
                 file.write(json.dumps(spawns))
                 log.info('Finished exporting spawn points')
 
-        argset = (args, mode, new_location_queue, pause_bit, encryption_lib_path, db_updates_queue, wh_updates_queue)
+        argset = (args, mode, new_location_queue, pause_bit, overseer_wakeup, encryption_lib_path, db_updates_queue, wh_updates_queue, work_leases)
 
         log.debug('Starting a %s search thread', mode)
         search_thread = Thread(target=search_overseer_thread, name='search-overseer', args=argset)
@@ -235,6 +244,7 @@ def main():
 
     app.set_search_control(pause_bit)
     app.set_location_queue(new_location_queue)
+    app.set_work_leases(work_leases)
 
     config['ROOT_PATH'] = app.root_path
     config['GMAPS_KEY'] = args.gmaps_key
@@ -0,0 +1,150 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import threading
+import time
+import unittest
+
+from queue import Empty
+
+from pogom.accounts import AccountPool, LoginManager
+
+
+def accounts(n):
+    return [{'username': 'user{}'.format(i)} for i in range(n)]
+
+
+class Auth(object):
+    def __init__(self, expires):
+        self._ticket_expire = expires * 1000
+
+
+class Api(object):
+    def __init__(self, expires):
+        self._auth_provider = Auth(expires)
+
+
+class FakeLoginManager(LoginManager):
+    # Logs in instantly, with tickets good for an hour
+
+    def __init__(self):
+        LoginManager.__init__(self, None, None, 1)
+        self.logins = []
+
+    def login(self, account, proxy_url):
+        self.logins.append(account['username'])
+        return Api(time.time() + 3600)
+
+    def wait_for(self, username):
+        deadline = time.time() + 2
+        while username not in self.ready and time.time() < deadline:
+            time.sleep(0.01)
+
+
+class AccountPoolTest(unittest.TestCase):
+
+    def test_healthiest_first(self):
+        pool = AccountPool(60)
+        first, second, third = accounts(3)
+        for i in range(5):
+            pool.record(first, 'fail')
+            pool.record(second, 'empty')
+            pool.record(third, 'success')
+        for account in (first, second, third):
+            pool.put(account)
+
+        self.assertEqual([pool.get()['username'] for i in range(3)], ['user2', 'user1', 'user0'])
+
+    def test_equal_health_in_order(self):
+        pool = AccountPool(60)
+        for account in accounts(3):
+            pool.put(account)
+        self.assertEqual([pool.get()['username'] for i in range(3)], ['user0', 'user1', 'user2'])
+
+    def test_bans_count_against_health(self):
+        pool = AccountPool(60)
+        account = accounts(1)[0]
+        pool.record(account, 'banned')
+        self.assertLess(pool.score('user0'), 0.8)
+
+    def test_bans_wear_off(self):
+        pool = AccountPool(60)
+        account = accounts(1)[0]
+        for i in range(2):
+            pool.record(account, 'banned')
+        banned = pool.score('user0')
+
+        pool.health['user0']['banned_at'] -= AccountPool.BAN_HALF_LIFE
+        # Two bans cost half a point, an hour later a quarter
+        self.assertAlmostEqual(pool.score('user0') - banned, 0.25, places=3)
+
+        pool.health['user0']['banned_at'] -= 10 * AccountPool.BAN_HALF_LIFE
+        # Only the failed scans still count, until it has some good ones
+        self.assertAlmostEqual(pool.score('user0'), 1 - pool.health['user0']['fail'], places=3)
+
+    def test_empty(self):
+        pool = AccountPool(60)
+        self.assertRaises(Empty, pool.get, False)
+        self.assertRaises(Empty, pool.get, True, 0.05)
+
+    def test_rest_and_holds(self):
+        pool = AccountPool(60)
+        first, second = accounts(2)
+        pool.rest(first, 'failures', since=time.time() - 30)
+        pool.rest(second, 'exception', since=time.time() - 50)
+
+        holds = pool.holds()
+        self.assertEqual([hold['account']['username'] for hold in holds], ['user1', 'user0'])
+        self.assertEqual([hold['reason'] for hold in holds], ['exception', 'failures'])
+        self.assertEqual(pool.qsize(), 0)
+        self.assertEqual(pool.resting_count(), 2)
+        self.assertRaises(Empty, pool.get, False)
+
+    def test_rested_account_wakes_getter(self):
+        pool = AccountPool(0.2)
+        pool.rest(accounts(1)[0], 'rotation')
+        got = []
+        t = threading.Thread(target=lambda: got.append(pool.get(timeout=2)))
+        t.start()
+        t.join()
+        self.assertEqual(got[0]['username'], 'user0')
+        self.assertEqual(pool.resting_count(), 0)
+
+
+class LoginManagerTest(unittest.TestCase):
+
+    def test_rested_account_logged_in_ahead(self):
+        manager = FakeLoginManager()
+        pool = AccountPool(3600, manager)
+        pool.rest(accounts(1)[0], 'failures')
+        self.assertAlmostEqual(manager.due[0][0], time.time() + 3600 - LoginManager.MARGIN, delta=5)
+
+    def test_spare_logged_in_once(self):
+        manager = FakeLoginManager()
+        manager.start()
+        account = accounts(1)[0]
+        manager.prepare(account)
+        manager.wait_for('user0')
+
+        self.assertEqual(manager.logins, ['user0'])
+        self.assertEqual(manager.due, [])
+        api, proxy_url = manager.take(account)
+        self.assertIsNotNone(api)
+
+        # Once it's searching, it's kept logged in
+        manager.keep_fresh(account, api, proxy_url)
+        self.assertEqual(len(manager.due), 1)
+        self.assertAlmostEqual(manager.due[0][0], time.time() + 3600 - LoginManager.MARGIN, delta=5)
+
+    def test_spare_taken_before_login_is_kept_fresh(self):
+        manager = FakeLoginManager()
+        account = accounts(1)[0]
+        manager.prepare(account, when=time.time() + 3600)
+        manager.keep_fresh(account, Api(time.time() + 600), None)
+        self.assertNotIn('user0', manager.spares)
+        # The refresh replaces the spare's login
+        self.assertEqual(manager.accounts['user0'][2], min(manager.due)[1])
+
+
+if __name__ == '__main__':
+    unittest.main()
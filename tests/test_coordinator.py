@@ -0,0 +1,59 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import cPickle as pickle
+import unittest
+
+from pogom.coordinator import CoordinatorQueue, LeasedItem
+
+
+class FakeCoordinator(object):
+    # Leases out the same hex step every time, like a step in two loops
+
+    def __init__(self):
+        self.leased = 0
+        self.acked = []
+
+    def __call__(self, path, data):
+        if path == '/work/lease':
+            self.leased += 1
+            return {'lease': 'lease{}'.format(self.leased), 'item': [3, [40.7, -74.0, 0], 0, 0]}
+        self.acked.append(data['lease'])
+        return {'acked': True}
+
+
+class CoordinatorQueueTest(unittest.TestCase):
+
+    def setUp(self):
+        self.coordinator = FakeCoordinator()
+        self.queue = CoordinatorQueue('http://coordinator/', 'node')
+        self.queue.request = self.coordinator
+
+    def test_equal_items_acked_separately(self):
+        first = self.queue.get()
+        second = self.queue.get()
+        self.assertEqual(first, second)
+        self.assertEqual(self.queue.qsize(), 2)
+
+        self.queue.task_done(second)
+        self.queue.task_done(first)
+        self.assertEqual(self.coordinator.acked, ['lease2', 'lease1'])
+        self.assertEqual(self.queue.qsize(), 0)
+
+    def test_acked_once(self):
+        item = self.queue.get()
+        self.queue.task_done(item)
+        self.queue.task_done(item)
+        self.assertEqual(self.coordinator.acked, ['lease1'])
+
+    def test_item_is_a_search_item(self):
+        step, location, appears, leaves = item = self.queue.get()
+        self.assertEqual(item, (3, (40.7, -74.0, 0), 0, 0))
+        # Items go to scanner processes pickled
+        copy = pickle.loads(pickle.dumps(item, pickle.HIGHEST_PROTOCOL))
+        self.assertIsInstance(copy, LeasedItem)
+        self.assertEqual(copy.lease, 'lease1')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,133 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# The models are defined from the command line when pogom.models is
+# imported, so every step runs in a fresh interpreter with its own flags
+PRELUDE = '''
+from flask import Flask
+from pogom.transform import get_cell_id
+from pogom import models
+from pogom.models import *
+db = models.init_database(Flask(__name__))
+'''
+
+# A database as version 7 left it: string ids, no cell ids and no active
+# pokemon table
+CREATE_V7 = '''
+from datetime import datetime, timedelta
+from playhouse.migrate import migrate, SqliteMigrator
+
+models.create_tables(db)
+later = datetime.utcnow() + timedelta(minutes=10)
+Pokemon.insert(encounter_id='MTIzNDU2Nzg5', spawnpoint_id='89c25a4b',
+               pokemon_id=16, latitude=40.7, longitude=-74.0, disappear_time=later).execute()
+# Sightings from before the v5 cleanup window
+for i in range(1, 6):
+    Pokemon.insert(encounter_id='OTg3NjU0MzI' + str(i), spawnpoint_id='89c25a4c',
+                   pokemon_id=19, latitude=40.7 + i / 100.0, longitude=-74.0,
+                   disappear_time=datetime.utcnow() - timedelta(days=2)).execute()
+Pokestop.insert(pokestop_id='abcdef.16', enabled=True, latitude=40.71, longitude=-74.01,
+                last_modified=datetime.utcnow()).execute()
+for i in range(3):
+    ScannedLocation.insert(latitude=40.7 + i / 100.0, longitude=-74.0, last_modified=datetime.utcnow()).execute()
+
+migrator = SqliteMigrator(db)
+for table in ['pokemon', 'pokestop', 'gym', 'scannedlocation']:
+    migrate(migrator.drop_column(table, 'cellid'))
+db.drop_tables([ActivePokemon])
+Versions.update(val=7).where(Versions.key == 'schema_version').execute()
+'''
+
+# Version 4: also before the v5 cleanup and gym.last_scanned
+CREATE_V4 = CREATE_V7 + '''
+migrate(migrator.drop_column('gym', 'last_scanned'))
+Versions.update(val=4).where(Versions.key == 'schema_version').execute()
+'''
+
+UPGRADE = '''
+models.create_tables(db)
+'''
+
+CHECK = '''
+import json
+print json.dumps({
+    'version': Versions.get(Versions.key == 'schema_version').val,
+    'pending': Versions.select().where(Versions.key.startswith(models.MIGRATION_PREFIX)).count(),
+    'types': db.execute_sql("SELECT typeof(encounter_id), typeof(spawnpoint_id) FROM pokemon").fetchone(),
+    'pokemon': list(Pokemon.select(Pokemon.encounter_id, Pokemon.spawnpoint_id, Pokemon.cellid)
+                    .order_by(Pokemon.disappear_time.desc(), Pokemon.latitude).tuples()),
+    'active': ActivePokemon.select().count(),
+    'pokestop_cellids': [row[0] for row in Pokestop.select(Pokestop.cellid).tuples()],
+    'scanned_cellids': [row[0] for row in ScannedLocation.select(ScannedLocation.cellid).tuples()],
+    'expected_cellids': [get_cell_id(row[0], row[1]) for row in Pokemon.select(Pokemon.latitude, Pokemon.longitude)
+                         .order_by(Pokemon.disappear_time.desc(), Pokemon.latitude).tuples()],
+})
+'''
+
+
+class MigrationTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.db = os.path.join(self.dir, 'pogom.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def run_step(self, code, *flags):
+        argv = [sys.executable, '-c', PRELUDE + code, '-k', 'test', '-os', '-l', '40.7,-74.0', '--db', self.db]
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join([ROOT] + sys.path))
+        return subprocess.check_output(argv + list(flags), cwd=self.dir, env=env, stderr=subprocess.STDOUT)
+
+    def upgrade(self, *flags, **kwargs):
+        self.run_step(kwargs.get('create', CREATE_V7))
+        self.run_step(UPGRADE, *flags)
+        return json.loads(self.run_step(CHECK, *flags).splitlines()[-1])
+
+    def test_upgrade_7_to_9(self):
+        result = self.upgrade()
+        self.assertEqual(result['version'], 9)
+        self.assertEqual(result['pending'], 0)
+        self.assertEqual(result['types'], ['text', 'text'])
+        self.assertEqual(result['active'], 1)
+        self.assertEqual([row[2] for row in result['pokemon']], result['expected_cellids'])
+        self.assertEqual(len(result['pokemon']), 6)
+        self.assertIsNotNone(result['pokestop_cellids'][0])
+        self.assertNotIn(None, result['scanned_cellids'])
+
+    def test_upgrade_7_to_9_compact_ids(self):
+        result = self.upgrade('--compact-ids')
+        self.assertEqual(result['version'], 9)
+        self.assertEqual(result['pending'], 0)
+        self.assertEqual(result['types'], ['integer', 'integer'])
+        encounter_id, spawnpoint_id, cellid = result['pokemon'][0]
+        self.assertEqual(encounter_id, 123456789)
+        self.assertEqual(spawnpoint_id, '89c25a4b')
+        self.assertEqual([row[2] for row in result['pokemon']], result['expected_cellids'])
+        self.assertEqual(result['active'], 1)
+        self.assertIsNotNone(result['pokestop_cellids'][0])
+        self.assertNotIn(None, result['scanned_cellids'])
+
+    def test_upgrade_4_to_9_compact_ids(self):
+        # The v5 cleanup runs before the ids are converted
+        result = self.upgrade('--compact-ids', create=CREATE_V4)
+        self.assertEqual(result['version'], 9)
+        self.assertEqual(result['pending'], 0)
+        self.assertEqual(result['types'], ['integer', 'integer'])
+        self.assertEqual(len(result['pokemon']), 5)
+        self.assertEqual([row[2] for row in result['pokemon']], result['expected_cellids'])
+        self.assertNotIn(None, result['scanned_cellids'])
+
+
+if __name__ == '__main__':
+    unittest.main()
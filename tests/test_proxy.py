@@ -0,0 +1,97 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import random
+import time
+import unittest
+
+from collections import Counter
+
+from pogom import proxy
+from pogom.proxy import ProxyPool
+
+PROXIES = ['http://a', 'http://b', 'http://c']
+
+
+class ProxyPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        random.seed(1)
+        self.pool = ProxyPool(PROXIES, 1, probe_interval=0.05, max_error_rate=0.5)
+        self.test_proxy = proxy.test_proxy
+
+    def tearDown(self):
+        proxy.test_proxy = self.test_proxy
+
+    def fail_requests(self, url, times=10):
+        for i in range(times):
+            self.pool.record(url, 1, False)
+
+    def picks(self, n=3000):
+        picks = Counter()
+        for i in range(n):
+            url = self.pool.acquire()
+            picks[url] += 1
+            self.pool.release(url)
+        return picks
+
+    def test_prefers_fast_reliable_proxies(self):
+        for i in range(10):
+            self.pool.record('http://a', 0.1, True)
+            self.pool.record('http://b', 0.5, True)
+            self.pool.record('http://c', 0.1, i % 4 != 0)
+
+        picks = self.picks()
+        self.assertGreater(picks['http://a'], picks['http://c'])
+        self.assertGreater(picks['http://c'], picks['http://b'])
+
+    def test_spreads_sessions(self):
+        held = Counter(self.pool.acquire() for i in range(30))
+        self.assertEqual(sorted(held), PROXIES)
+        self.assertTrue(all(n >= 5 for n in held.values()))
+
+    def test_not_evicted_before_min_requests(self):
+        self.fail_requests('http://a', ProxyPool.MIN_REQUESTS - 1)
+        self.assertTrue(self.pool.usable('http://a'))
+
+    def test_eviction(self):
+        self.fail_requests('http://c')
+        self.assertFalse(self.pool.usable('http://c'))
+        self.assertNotIn('http://c', self.picks(300))
+        # Sessions move off it, and it isn't kept when preferred
+        self.assertNotEqual(self.pool.acquire('http://c'), 'http://c')
+        self.assertNotEqual(self.pool.acquire(prefer='http://c'), 'http://c')
+
+    def test_keeps_preferred(self):
+        self.assertEqual(self.pool.acquire(prefer='http://b'), 'http://b')
+        self.assertEqual(self.pool.status()[1]['sessions'], 1)
+
+    def test_all_evicted(self):
+        for url in PROXIES:
+            self.fail_requests(url)
+        self.pool.record('http://b', 1, True)
+        # Rather the least bad proxy than none
+        self.assertEqual(self.pool.acquire(), 'http://b')
+        self.assertTrue(self.pool.usable('http://a'))
+
+    def test_probe_admits_again(self):
+        probes = []
+
+        def probe(url, timeout):
+            probes.append(url)
+            return None if len(probes) > 1 else 'timed out'
+
+        proxy.test_proxy = probe
+        self.fail_requests('http://c')
+        self.pool.start()
+
+        deadline = time.time() + 2
+        while self.pool.status()[2]['evicted'] and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(probes[:2], ['http://c', 'http://c'])
+        self.assertFalse(self.pool.status()[2]['evicted'])
+        self.assertEqual(self.pool.status()[2]['errors'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,104 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import random
+import threading
+import time
+import unittest
+
+from queue import Empty
+
+from pogom.queues import ScheduledQueue
+
+
+def item(step, lat, appears=0, leaves=0):
+    return (step, (lat, -74.0, 0), appears, leaves)
+
+
+class ScheduledQueueTest(unittest.TestCase):
+
+    def test_due_order(self):
+        q = ScheduledQueue(delay=10)
+        start = time.time() - 100
+        q.put(item(1, 40.0, start + 30))
+        q.put(item(2, 40.0, start + 10))
+        q.put(item(3, 40.0))
+        q.put(item(4, 40.0, start + 20))
+        q.put(item(5, 40.0))
+        self.assertEqual([i[0] for i in q.items()], [3, 5, 2, 4, 1])
+        self.assertEqual([q.get()[0] for i in range(5)], [3, 5, 2, 4, 1])
+
+    def test_get_waits_until_due(self):
+        q = ScheduledQueue(delay=0)
+        q.put(item(1, 40.0, time.time() + 0.2))
+        self.assertRaises(Empty, q.get, False)
+        self.assertRaises(Empty, q.get, True, 0.05)
+
+        started = time.time()
+        self.assertEqual(q.get()[0], 1)
+        self.assertGreaterEqual(time.time() - started, 0.1)
+
+    def test_put_wakes_getter_for_sooner_item(self):
+        q = ScheduledQueue(delay=0)
+        q.put(item(1, 40.0, time.time() + 5))
+        got = []
+        t = threading.Thread(target=lambda: got.append(q.get(timeout=2)))
+        t.start()
+        time.sleep(0.05)
+        q.put(item(2, 40.0))
+        t.join()
+        self.assertEqual(got[0][0], 2)
+
+    def test_nearest_reachable_item(self):
+        # At 10 m/s an item 1.1km away takes 110s to reach, so the one due later but next door goes first
+        q = ScheduledQueue(speed=10)
+        start = time.time()
+        q.put(item(1, 40.01, start - 5))
+        q.put(item(2, 40.0001, start - 1))
+        self.assertEqual(q.get(position=(40.0, -74.0, 0), last_scan=start)[0], 2)
+        self.assertEqual(q.get()[0], 1)
+
+    def test_next_matches_brute_force(self):
+        random.seed(1)
+        q = ScheduledQueue(speed=20)
+        start = time.time()
+        for i in range(ScheduledQueue.WINDOW // 2):
+            q.put(item(i, 40.0 + random.uniform(0, 0.05), start + random.uniform(-60, 60)))
+
+        for i in range(20):
+            position = (40.0 + random.uniform(0, 0.05), -74.0, 0)
+            last_scan = start + random.uniform(-30, 30)
+            best = min((max(due, last_scan + q.travel_time(position, entry)), due, sequence)
+                       for due, sequence, entry in q.queue)
+            self.assertEqual(q._next(position, last_scan)[0], best[0])
+
+    def test_reschedule_drops_and_rekeys(self):
+        q = ScheduledQueue()
+        start = time.time()
+        for i in range(3):
+            q.put(item(i, 40.0, start - 10 + i, start + 60))
+
+        # Nothing changed, nothing to do
+        self.assertEqual(q.reschedule(lambda entry: entry), 0)
+        self.assertEqual(q.unfinished_tasks, 3)
+
+        self.assertEqual(q.reschedule(lambda entry: None if entry[0] == 0 else entry), 1)
+        self.assertEqual(q.unfinished_tasks, 2)
+        self.assertEqual([i[0] for i in q.items()], [1, 2])
+
+        q.reschedule(lambda entry: item(entry[0], 40.0, start - 10 - entry[0], entry[3]))
+        self.assertEqual([i[0] for i in q.items()], [2, 1])
+
+    def test_low_water_sets_wakeup(self):
+        wakeup = threading.Event()
+        q = ScheduledQueue(low_water=1, wakeup=wakeup)
+        for i in range(3):
+            q.put(item(i, 40.0))
+        q.get()
+        self.assertFalse(wakeup.is_set())
+        q.get()
+        self.assertTrue(wakeup.is_set())
+
+
+if __name__ == '__main__':
+    unittest.main()
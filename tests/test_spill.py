@@ -0,0 +1,82 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from pogom import queues
+from pogom.queues import SpillQueue
+
+
+class SpillQueueTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'db-queue-0.spill')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def drain(self, q, n=None):
+        items = []
+        while q.qsize() and (n is None or len(items) < n):
+            items.append(q.get())
+            q.task_done()
+        return items
+
+    def test_fifo_past_memory_size(self):
+        q = SpillQueue(self.path, 5)
+        for i in range(20):
+            q.put(i)
+        self.assertEqual(self.drain(q), range(20))
+
+    def test_in_memory_items_survive_a_crash(self):
+        q = SpillQueue(self.path, 500)
+        for i in range(3):
+            q.put(i)
+        # Taken, but never acknowledged
+        q.get()
+
+        # The process dies without closing the queue
+        self.assertEqual(self.drain(SpillQueue(self.path, 500)), [0, 1, 2])
+
+    def test_acknowledged_items_are_not_replayed(self):
+        q = SpillQueue(self.path, 5)
+        for i in range(2 * queues.COMMIT_RECORDS):
+            q.put(i)
+        self.drain(q, queues.COMMIT_RECORDS)
+
+        replayed = self.drain(SpillQueue(self.path, 5))
+        self.assertEqual(replayed, range(queues.COMMIT_RECORDS, 2 * queues.COMMIT_RECORDS))
+
+    def test_close_saves_the_last_batch(self):
+        q = SpillQueue(self.path, 5)
+        for i in range(10):
+            q.put(i)
+        self.drain(q, 4)
+        q.close()
+
+        self.assertEqual(self.drain(SpillQueue(self.path, 5)), range(4, 10))
+
+    def test_offset_saved_in_batches(self):
+        # Only count the batches, not the timer
+        interval, queues.COMMIT_INTERVAL = queues.COMMIT_INTERVAL, 3600
+        self.addCleanup(setattr, queues, 'COMMIT_INTERVAL', interval)
+
+        q = SpillQueue(self.path, 50)
+        commits = []
+        commit = q._commit
+        q._commit = lambda offset: commits.append(offset) or commit(offset)
+
+        for i in range(10 * queues.COMMIT_RECORDS):
+            q.put(i)
+        self.drain(q)
+        self.assertLessEqual(len(commits), 10)
+        # Started over once everything was acknowledged
+        self.assertEqual(os.path.getsize(self.path), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()